@@ -0,0 +1,8 @@
+"""Default profile for local development: PostgreSQL with DEBUG on.
+
+Use ``config.settings.test`` for a database-free fast profile and
+``config.settings.production`` for deployments.
+"""
+from .base import *  # noqa: F401,F403
+
+DEBUG = True
@@ -1,11 +1,12 @@
+"""Settings shared by every profile (see local defaults in __init__.py, test.py and production.py)"""
 import os
 from pathlib import Path
 
-BASE_DIR = Path(__file__).resolve().parent.parent
+BASE_DIR = Path(__file__).resolve().parent.parent.parent
 
 SECRET_KEY = os.environ.get('DJANGO_SECRET', 'change-me-for-prod')
 
-DEBUG = True
+DEBUG = False
 
 ALLOWED_HOSTS = []
 
@@ -25,6 +26,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'innercircle.ratelimit.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -77,7 +79,27 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    # Item photos and avatars, see innercircle/storage.py
+    'blobs': {'BACKEND': 'innercircle.storage.ContentAddressedStorage'},
+}
+
+# Uploads above 1 MB are spooled to a temp file and streamed to storage in chunks
+FILE_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'item_list'
+
+# Token-bucket limits per URL name, see innercircle/ratelimit.py
+RATELIMIT_BACKEND = os.environ.get('RATELIMIT_BACKEND', 'local')  # 'local' or 'cache'
+RATELIMITS = {
+    'login': {'rate': '10/m', 'key': 'ip', 'methods': ['POST']},
+    'register': {'rate': '5/h', 'key': 'ip', 'methods': ['POST']},
+    'friend_request_create': {'rate': '60/h'},
+    'friend_contacts': {'rate': '20/h', 'methods': ['POST']},
+    'request_create': {'rate': '30/h', 'methods': ['POST']},
+}
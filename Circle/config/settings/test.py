@@ -0,0 +1,32 @@
+"""Fast profile for tests and quick local runs: no external services needed"""
+from .base import *  # noqa: F401,F403
+
+DEBUG = False
+
+ALLOWED_HOSTS = ['*']
+
+# A file, not ':memory:', so the async views' worker connections see the same
+# data during local runs. The test runner still uses a shared in-memory database.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'db.test.sqlite3',  # noqa: F405
+    }
+}
+
+# Hashing cost dominates user-creating tests; never use this hasher for real accounts
+PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher']
+
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+}
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.InMemoryStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'blobs': {'BACKEND': 'innercircle.storage.InMemoryContentAddressedStorage'},
+}
+
+EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+
+RATELIMITS = {}
@@ -1,29 +1,90 @@
+from datetime import timedelta
+
 from django.contrib import admin
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import OuterRef, Q
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.html import format_html
-from .models import Profile, Item, FriendRequest, SwapRequest, Notification
+from .models import (
+    Profile, Item, FriendRequest, SwapRequest, Notification, ArchivedItem, ArchivedSwapRequest, SubqueryCount,
+    hash_email,
+)
+
+STALE_SWAP_DAYS = 30
+
+
+class EstimatedCountPaginator(Paginator):
+    """Use PostgreSQL's row estimate instead of COUNT(*) for unfiltered changelists"""
+    exact_count_threshold = 10000
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        connection = connections[queryset.db]
+        if connection.vendor == 'postgresql' and not queryset.query.where:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    "SELECT reltuples::bigint FROM pg_class WHERE relname = %s",
+                    [queryset.model._meta.db_table],
+                )
+                row = cursor.fetchone()
+            # Small tables are cheap to count exactly, and their estimate may be stale
+            if row and row[0] > self.exact_count_threshold:
+                return row[0]
+        return super().count
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 @admin.register(Profile)
-class ProfileAdmin(admin.ModelAdmin):
+class ProfileAdmin(LargeTableAdmin):
     list_display = ('user', 'items_count', 'friends_count', 'updated_at')
-    search_fields = ('user__username', 'user__email')
+    list_select_related = ('user',)
+    search_fields = ('user__username__startswith',)
+    search_help_text = "Username prefix, or a full email address"
     readonly_fields = ('created_at', 'updated_at')
+    raw_id_fields = ('user',)
+
+    def get_search_results(self, request, queryset, search_term):
+        if '@' in search_term:
+            # auth_user.email has no index; the profile keeps an indexed hash of it
+            return queryset.filter(email_hash=hash_email(search_term)), False
+        return super().get_search_results(request, queryset, search_term)
+
+    def get_queryset(self, request):
+        # Annotated so the changelist doesn't run two COUNT queries per row
+        return super().get_queryset(request).annotate(
+            items_count=SubqueryCount(Item.objects.filter(owner=OuterRef('user'))),
+            friends_count=SubqueryCount(FriendRequest.objects.filter(
+                Q(from_user=OuterRef('user')) | Q(to_user=OuterRef('user')), accepted=True
+            )),
+        )
 
     def items_count(self, obj):
         return obj.get_items_count()
     items_count.short_description = "Items"
+    items_count.admin_order_field = 'items_count'
 
     def friends_count(self, obj):
         return obj.get_friends_count()
     friends_count.short_description = "Friends"
+    friends_count.admin_order_field = 'friends_count'
 
 
 @admin.register(Item)
-class ItemAdmin(admin.ModelAdmin):
+class ItemAdmin(LargeTableAdmin):
     list_display = ('title', 'owner', 'category', 'condition', 'availability_badge', 'created_at')
     list_filter = ('category', 'condition', 'is_available', 'created_at')
-    search_fields = ('title', 'owner__username', 'description')
+    list_select_related = ('owner',)
+    search_fields = ('title__startswith', 'owner__username__startswith')
     readonly_fields = ('created_at', 'updated_at')
+    raw_id_fields = ('owner',)
+    actions = ('mark_unavailable',)
     fieldsets = (
         ('Ownership', {'fields': ('owner',)}),
         ('Content', {'fields': ('title', 'description', 'photo')}),
@@ -37,13 +98,20 @@ class ItemAdmin(admin.ModelAdmin):
         return format_html(f'<span style="background-color: #{color}; padding: 5px 10px; border-radius: 3px;">{status}</span>')
     availability_badge.short_description = "Status"
 
+    def mark_unavailable(self, request, queryset):
+        updated = queryset.filter(is_available=True).update(is_available=False, updated_at=timezone.now())
+        self.message_user(request, f"Marked {updated} items unavailable.")
+    mark_unavailable.short_description = "Mark selected items unavailable"
+
 
 @admin.register(FriendRequest)
-class FriendRequestAdmin(admin.ModelAdmin):
+class FriendRequestAdmin(LargeTableAdmin):
     list_display = ('from_user', 'to_user', 'status_badge', 'created_at')
     list_filter = ('accepted', 'created_at')
-    search_fields = ('from_user__username', 'to_user__username')
+    list_select_related = ('from_user', 'to_user')
+    search_fields = ('from_user__username__startswith', 'to_user__username__startswith')
     readonly_fields = ('created_at', 'accepted_at')
+    raw_id_fields = ('from_user', 'to_user')
 
     def status_badge(self, obj):
         color = '90EE90' if obj.accepted else 'FFD700'
@@ -53,11 +121,14 @@ class FriendRequestAdmin(admin.ModelAdmin):
 
 
 @admin.register(SwapRequest)
-class SwapRequestAdmin(admin.ModelAdmin):
+class SwapRequestAdmin(LargeTableAdmin):
     list_display = ('sender', 'receiver', 'item', 'status_badge', 'created_at')
     list_filter = ('status', 'created_at')
-    search_fields = ('sender__username', 'receiver__username', 'item__title')
+    list_select_related = ('sender', 'receiver', 'item', 'item__owner')
+    search_fields = ('sender__username__startswith', 'receiver__username__startswith', 'item__title__startswith')
     readonly_fields = ('created_at', 'updated_at')
+    raw_id_fields = ('sender', 'receiver', 'item')
+    actions = ('cancel_stale_swaps',)
     fieldsets = (
         ('Users', {'fields': ('sender', 'receiver')}),
         ('Item', {'fields': ('item',)}),
@@ -77,13 +148,24 @@ class SwapRequestAdmin(admin.ModelAdmin):
         return format_html(f'<span style="background-color: #{color}; padding: 5px 10px; border-radius: 3px;">{obj.get_status_display()}</span>')
     status_badge.short_description = "Status"
 
+    def cancel_stale_swaps(self, request, queryset):
+        now = timezone.now()
+        updated = queryset.filter(
+            status='pending', created_at__lt=now - timedelta(days=STALE_SWAP_DAYS)
+        ).update(status='cancelled', updated_at=now)
+        self.message_user(request, f"Cancelled {updated} pending swaps older than {STALE_SWAP_DAYS} days.")
+    cancel_stale_swaps.short_description = f"Cancel selected swaps pending over {STALE_SWAP_DAYS} days"
+
 
 @admin.register(Notification)
-class NotificationAdmin(admin.ModelAdmin):
+class NotificationAdmin(LargeTableAdmin):
     list_display = ('user', 'text', 'notification_type', 'read_badge', 'created_at')
     list_filter = ('notification_type', 'read', 'created_at')
-    search_fields = ('user__username', 'text')
+    list_select_related = ('user',)
+    search_fields = ('user__username__startswith',)
     readonly_fields = ('created_at', 'read_at')
+    raw_id_fields = ('user',)
+    actions = ('purge_read',)
 
     def read_badge(self, obj):
         color = '90EE90' if obj.read else 'FFD700'
@@ -91,3 +173,28 @@ class NotificationAdmin(admin.ModelAdmin):
         return format_html(f'<span style="background-color: #{color}; padding: 5px 10px; border-radius: 3px;">{status}</span>')
     read_badge.short_description = "Read Status"
 
+    def purge_read(self, request, queryset):
+        # Notifications have no dependents, so this is a single DELETE statement
+        deleted, _ = queryset.filter(read=True).delete()
+        self.message_user(request, f"Purged {deleted} read notifications.")
+    purge_read.short_description = "Purge selected read notifications"
+
+
+@admin.register(ArchivedItem)
+class ArchivedItemAdmin(LargeTableAdmin):
+    list_display = ('title', 'owner', 'category', 'created_at', 'archived_at')
+    list_filter = ('category',)
+    list_select_related = ('owner',)
+    search_fields = ('title__startswith', 'owner__username__startswith')
+    readonly_fields = ('original_id', 'created_at', 'updated_at', 'archived_at')
+    raw_id_fields = ('owner',)
+
+
+@admin.register(ArchivedSwapRequest)
+class ArchivedSwapRequestAdmin(LargeTableAdmin):
+    list_display = ('sender', 'receiver', 'item_title', 'status', 'created_at', 'archived_at')
+    list_filter = ('status',)
+    list_select_related = ('sender', 'receiver')
+    search_fields = ('sender__username__startswith', 'receiver__username__startswith', 'item_title__startswith')
+    readonly_fields = ('original_id', 'original_item_id', 'created_at', 'updated_at', 'archived_at')
+    raw_id_fields = ('sender', 'receiver')
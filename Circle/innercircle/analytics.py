@@ -0,0 +1,182 @@
+"""Platform metrics for ops, computed with database-side aggregation.
+
+Swap metrics are rolled up weekly into ``MetricRollup``. Each run only
+processes swaps accepted or completed since the ``AnalyticsCheckpoint``, up to
+a few minutes ago so that transactions still in flight land in the next run.
+Archived swaps are read too, so a rebuild still covers swaps that
+``archive_cold_data`` has moved out of the hot table. Both hold the checkpoint
+lock, so a run never sees a swap in both tables or in neither. Acceptance
+latency is stored as a histogram of log-spaced buckets, so weekly medians merge
+without keeping per-row data. Friend degree and items per user are snapshots,
+built by merging ordered per-user counts streamed from the database.
+"""
+import heapq
+import math
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from itertools import groupby
+from operator import itemgetter
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, TruncWeek
+from django.utils import timezone
+
+from .models import (
+    AnalyticsCheckpoint, ArchivedItem, ArchivedSwapRequest, FriendRequest, Item, MetricRollup, SwapRequest,
+)
+
+User = get_user_model()
+
+CHECKPOINT = 'swap_rollups'
+BUCKETS_PER_DOUBLING = 4
+CHUNK_SIZE = 2000
+# Swaps stamped within this long of now may belong to transactions that haven't committed yet
+SAFETY_LAG = timedelta(minutes=5)
+
+
+def latency_bucket(seconds):
+    """Quarter-octave bucket of a duration in minutes (~19% resolution)"""
+    return int(BUCKETS_PER_DOUBLING * math.log2(max(seconds, 0) / 60 + 1))
+
+
+def bucket_minutes(bucket):
+    """Representative duration of a bucket (its midpoint), in minutes"""
+    low = 2 ** (bucket / BUCKETS_PER_DOUBLING) - 1
+    high = 2 ** ((bucket + 1) / BUCKETS_PER_DOUBLING) - 1
+    return (low + high) / 2
+
+
+def week_start(moment):
+    day = timezone.localtime(moment).date()
+    return day - timedelta(days=day.weekday())
+
+
+def _swap_sources():
+    """(queryset, category expression) for live and archived swaps"""
+    # An archived swap's item may itself be live or archived
+    archived_category = Coalesce(
+        Subquery(Item.objects.filter(pk=OuterRef('original_item_id')).values('category')[:1]),
+        Subquery(ArchivedItem.objects.filter(original_id=OuterRef('original_item_id')).values('category')[:1]),
+        Value('other'),
+    )
+    return (
+        (SwapRequest.objects.all(), F('item__category')),
+        (ArchivedSwapRequest.objects.all(), archived_category),
+    )
+
+
+def lock_checkpoint():
+    """Lock the rollup checkpoint until the current transaction ends.
+
+    ``archive_cold_data`` takes the same lock before moving swaps, so they
+    can't change tables while a rollup reads them.
+    """
+    epoch = timezone.make_aware(datetime(2000, 1, 1))
+    AnalyticsCheckpoint.objects.get_or_create(name=CHECKPOINT, defaults={'position': epoch})
+    return AnalyticsCheckpoint.objects.select_for_update().get(name=CHECKPOINT)
+
+
+def update_rollups(until=None):
+    """Fold swaps accepted/completed since the checkpoint into the weekly rollups"""
+    until = until or timezone.now() - SAFETY_LAG
+    with transaction.atomic():
+        checkpoint = lock_checkpoint()
+        since = checkpoint.position
+        if until <= since:
+            return 0
+
+        deltas = Counter()
+        for swaps, category in _swap_sources():
+            completed = (
+                swaps.filter(completed_at__gt=since, completed_at__lte=until)
+                .annotate(week=TruncWeek('completed_at'), category=category)
+                .values('week', 'category')
+                .annotate(swaps=Count('pk'))
+                .order_by()
+            )
+            for row in completed:
+                deltas['swaps_completed', row['week'].date(), row['category']] += row['swaps']
+
+            accepted = swaps.filter(accepted_at__gt=since, accepted_at__lte=until)
+            for created_at, accepted_at in accepted.values_list('created_at', 'accepted_at').iterator(chunk_size=CHUNK_SIZE):
+                bucket = latency_bucket((accepted_at - created_at).total_seconds())
+                deltas['accept_latency', week_start(accepted_at), str(bucket)] += 1
+
+        for (metric, period, dimension), value in deltas.items():
+            MetricRollup.objects.add(metric, period, dimension, value)
+        checkpoint.position = until
+        checkpoint.save()
+    return sum(deltas.values())
+
+
+def reset_rollups():
+    with transaction.atomic():
+        MetricRollup.objects.all().delete()
+        AnalyticsCheckpoint.objects.filter(name=CHECKPOINT).delete()
+
+
+def _merged_counts(*streams):
+    """Sum several (key, count) streams that are each ordered by key"""
+    for key, rows in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        yield key, sum(count for _, count in rows)
+
+
+def _counts_by(queryset, field):
+    return (
+        queryset.values(field).annotate(total=Count('pk')).order_by(field)
+        .values_list(field, 'total').iterator(chunk_size=CHUNK_SIZE)
+    )
+
+
+def _distribution(*streams):
+    """Histogram {count: number of users}, including users with zero"""
+    histogram = Counter(count for _, count in _merged_counts(*streams))
+    histogram[0] += User.objects.count() - sum(histogram.values())
+    return dict(sorted(histogram.items()))
+
+
+def degree_distribution():
+    friendships = FriendRequest.objects.filter(accepted=True)
+    return _distribution(_counts_by(friendships, 'from_user'), _counts_by(friendships, 'to_user'))
+
+
+def items_per_user_distribution():
+    return _distribution(_counts_by(Item.objects.all(), 'owner'), _counts_by(ArchivedItem.objects.all(), 'owner'))
+
+
+def report_rows():
+    """Yield (metric, period, dimension, value) rows for the whole report"""
+    rollups = MetricRollup.objects.order_by('metric', 'period', 'dimension')
+    for row in rollups.filter(metric='swaps_completed').values_list('period', 'dimension', 'value').iterator():
+        yield ('swaps_completed', *row)
+
+    latency = rollups.filter(metric='accept_latency').values_list('period', 'dimension', 'value')
+    for period, rows in groupby(latency.iterator(), key=itemgetter(0)):
+        histogram = defaultdict(int)
+        for _, bucket, count in rows:
+            histogram[int(bucket)] += count
+        yield ('median_accept_minutes', period, '', round(median_from_histogram(histogram), 1))
+
+    for degree, users in degree_distribution().items():
+        yield ('friend_degree', '', str(degree), users)
+    for items, users in items_per_user_distribution().items():
+        yield ('items_per_user', '', str(items), users)
+
+
+def median_from_histogram(histogram):
+    total = sum(histogram.values())
+    seen = 0
+    for bucket in sorted(histogram):
+        seen += histogram[bucket]
+        if seen * 2 >= total:
+            return bucket_minutes(bucket)
+    return 0.0
+
+
+def report_json():
+    report = defaultdict(list)
+    for metric, period, dimension, value in report_rows():
+        report[metric].append({'period': str(period), 'dimension': dimension, 'value': value})
+    return dict(report)
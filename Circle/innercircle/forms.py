@@ -1,3 +1,6 @@
+import codecs
+import re
+
 from django import forms
 from django.contrib.auth.forms import UserCreationForm, PasswordChangeForm
 from django.contrib.auth import get_user_model
@@ -76,10 +79,11 @@ class ProfileForm(forms.ModelForm):
 
     class Meta:
         model = Profile
-        fields = ['avatar', 'bio']
+        fields = ['avatar', 'bio', 'digest_notifications']
         widgets = {
             'avatar': forms.FileInput(attrs={'class': 'form-control'}),
             'bio': forms.Textarea(attrs={'class': 'form-control', 'rows': 4, 'placeholder': 'Tell us about yourself'}),
+            'digest_notifications': forms.CheckboxInput(attrs={'class': 'form-check-input'}),
         }
 
     def clean_bio(self):
@@ -95,3 +99,54 @@ class SwapRequestForm(forms.Form):
         widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 3, 'placeholder': 'Add a message (optional)'})
     )
 
+
+class ContactMatchForm(forms.Form):
+    MAX_CONTACTS = 5000
+    MAX_UPLOAD_SIZE = 2 * 1024 * 1024
+    EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+
+    emails = forms.CharField(
+        required=False,
+        widget=forms.Textarea(attrs={'class': 'form-control', 'rows': 6, 'placeholder': 'Paste email addresses, one per line or comma separated'})
+    )
+    contacts_file = forms.FileField(
+        required=False,
+        help_text="Or upload an address-book export (CSV or vCard)",
+        widget=forms.FileInput(attrs={'class': 'form-control', 'accept': '.csv,.vcf,.txt'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        upload = cleaned_data.get('contacts_file')
+        if upload and upload.size > self.MAX_UPLOAD_SIZE:
+            raise ValidationError(
+                f"Please upload an address book of at most {self.MAX_UPLOAD_SIZE // (1024 * 1024)} MB."
+            )
+        lines = (cleaned_data.get('emails') or '').splitlines()
+        addresses = self._find_addresses(lines, self._read_lines(upload) if upload else ())
+        if not addresses:
+            raise ValidationError("No email addresses found.")
+        if len(addresses) > self.MAX_CONTACTS:
+            raise ValidationError(f"Please upload at most {self.MAX_CONTACTS} addresses at a time.")
+        cleaned_data['addresses'] = addresses
+        return cleaned_data
+
+    def _find_addresses(self, *sources):
+        """Distinct lowercased addresses, stopping once there are too many to accept"""
+        found = {}
+        for source in sources:
+            for line in source:
+                for match in self.EMAIL_RE.findall(line):
+                    found.setdefault(match.lower())
+                    if len(found) > self.MAX_CONTACTS:
+                        return list(found)
+        return list(found)
+
+    def _read_lines(self, upload):
+        """Decode the upload a chunk at a time, yielding whole lines"""
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='ignore')
+        tail = ''
+        for chunk in upload.chunks():
+            *lines, tail = (tail + decoder.decode(chunk)).split('\n')
+            yield from lines
+        yield tail + decoder.decode(b'', final=True)
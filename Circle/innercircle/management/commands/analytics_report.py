@@ -0,0 +1,35 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand
+
+from innercircle import analytics
+
+
+class Command(BaseCommand):
+    help = "Update the incremental swap rollups and write the platform metrics report"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+        parser.add_argument('--output', help="File to write (default: stdout)")
+        parser.add_argument('--rebuild', action='store_true', help="Drop the rollups and reprocess every swap")
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            analytics.reset_rollups()
+        processed = analytics.update_rollups()
+        self.stderr.write(f"Rolled up {processed} new swap events.")
+
+        out = open(options['output'], 'w', newline='') if options['output'] else sys.stdout
+        try:
+            if options['format'] == 'json':
+                json.dump(analytics.report_json(), out, indent=2)
+                out.write('\n')
+            else:
+                writer = csv.writer(out)
+                writer.writerow(('metric', 'period', 'dimension', 'value'))
+                writer.writerows(analytics.report_rows())
+        finally:
+            if out is not sys.stdout:
+                out.close()
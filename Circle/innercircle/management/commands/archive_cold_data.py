@@ -0,0 +1,96 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from innercircle.analytics import lock_checkpoint
+from innercircle.models import ArchivedItem, ArchivedSwapRequest, Item, MediaBlob, SwapRequest
+
+
+class Command(BaseCommand):
+    help = "Move long-unavailable items and finished swap requests into the archive tables"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=90, help="Archive rows untouched for this many days")
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_size = options['batch_size']
+
+        # Items with open swaps stay hot so those swaps keep their foreign key
+        open_swaps = SwapRequest.objects.filter(item=OuterRef('pk')).exclude(
+            status__in=SwapRequest.FINISHED_STATUSES
+        )
+        cold_items = Item.objects.filter(is_available=False, updated_at__lt=cutoff).exclude(Exists(open_swaps))
+        finished_swaps = SwapRequest.objects.filter(status__in=SwapRequest.FINISHED_STATUSES)
+
+        swaps_moved = items_moved = 0
+        for batch in self._batches(finished_swaps.filter(updated_at__lt=cutoff), batch_size):
+            with transaction.atomic():
+                swaps_moved += self._archive_swaps(finished_swaps.filter(pk__in=batch))
+        for batch in self._batches(cold_items, batch_size):
+            with transaction.atomic():
+                # Deleting an item cascades to its swaps, so archive them first
+                swaps_moved += self._archive_swaps(finished_swaps.filter(item_id__in=batch))
+                items_moved += self._archive_items(Item.objects.filter(pk__in=batch))
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {items_moved} items and {swaps_moved} swap requests."
+        ))
+
+    def _batches(self, queryset, batch_size):
+        # Always re-read the head: archived rows vanish from the queryset
+        while True:
+            batch = list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return
+            yield batch
+
+    def _archive_swaps(self, queryset):
+        # Hold off analytics rollups while swaps move between tables
+        lock_checkpoint()
+        swaps = list(queryset.select_related('item'))
+        ArchivedSwapRequest.objects.bulk_create([
+            ArchivedSwapRequest(
+                original_id=sr.pk,
+                sender_id=sr.sender_id,
+                receiver_id=sr.receiver_id,
+                original_item_id=sr.item_id,
+                item_title=sr.item.title,
+                message=sr.message,
+                status=sr.status,
+                created_at=sr.created_at,
+                updated_at=sr.updated_at,
+                accepted_at=sr.accepted_at,
+                completed_at=sr.completed_at,
+            )
+            for sr in swaps
+        ], ignore_conflicts=True)
+        SwapRequest.objects.filter(pk__in=[sr.pk for sr in swaps]).delete()
+        return len(swaps)
+
+    def _archive_items(self, queryset):
+        items = list(queryset)
+        ArchivedItem.objects.bulk_create([
+            ArchivedItem(
+                original_id=item.pk,
+                owner_id=item.owner_id,
+                title=item.title,
+                description=item.description,
+                photo=item.photo.name,
+                category=item.category,
+                size=item.size,
+                condition=item.condition,
+                created_at=item.created_at,
+                updated_at=item.updated_at,
+            )
+            for item in items
+        ], ignore_conflicts=True)
+        # bulk_create sends no signals: take the archive's photo references
+        # before the item deletes release theirs
+        MediaBlob.objects.retain([item.photo.name for item in items if item.photo])
+        Item.objects.filter(pk__in=[item.pk for item in items]).delete()
+        return len(items)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from innercircle.models import Profile, hash_email
+
+
+class Command(BaseCommand):
+    help = "Fill Profile.email_hash for profiles created before contact matching existed"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        batch, updated = [], 0
+        profiles = Profile.objects.filter(email_hash='').exclude(user__email='').select_related('user')
+        for profile in profiles.iterator(chunk_size=options['batch_size']):
+            profile.email_hash = hash_email(profile.user.email)
+            batch.append(profile)
+            if len(batch) >= options['batch_size']:
+                updated += Profile.objects.bulk_update(batch, ['email_hash'])
+                batch = []
+        if batch:
+            updated += Profile.objects.bulk_update(batch, ['email_hash'])
+        self.stdout.write(self.style.SUCCESS(f"Updated {updated} profiles."))
@@ -0,0 +1,121 @@
+import os
+import shutil
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+
+from innercircle.models import BLOB_FIELDS, MediaBlob
+from innercircle.storage import blob_storage
+
+
+class Command(BaseCommand):
+    help = "Move existing media into content-addressed blobs, dropping duplicate files"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Report savings without changing anything")
+        parser.add_argument('--delete-orphans', action='store_true', help="Also delete files no row references")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        referenced = set()
+        for model, field in BLOB_FIELDS:
+            names = model.objects.exclude(**{field: ''}).exclude(**{f'{field}__isnull': True})
+            referenced.update(names.values_list(field, flat=True).distinct().iterator(chunk_size=2000))
+
+        moved = duplicates = missing = 0
+        saved_bytes = 0
+        seen = set()
+        for name in sorted(referenced):
+            if blob_storage.is_blob(name):
+                continue
+            if not blob_storage.exists(name):
+                missing += 1
+                continue
+            blob = blob_storage.blob_name(blob_storage.hash_file(name), os.path.splitext(name)[1].lower())
+            duplicate = blob in seen or blob_storage.exists(blob)
+            if duplicate:
+                duplicates += 1
+                saved_bytes += blob_storage.size(name)
+            else:
+                seen.add(blob)
+                moved += 1
+            if dry_run:
+                continue
+            if not duplicate:
+                self._link_blob(name, blob)
+            # Rows point at the blob before the original goes, so a crash never leaves them dangling
+            with transaction.atomic():
+                for model, field in BLOB_FIELDS:
+                    model.objects.filter(**{field: name}).update(**{field: blob})
+            blob_storage.delete(name)
+
+        orphans, orphan_bytes = self._orphans(referenced)
+        if options['delete_orphans'] and not dry_run:
+            for name in orphans:
+                blob_storage.delete(name)
+        if not dry_run:
+            self._rebuild_counts()
+
+        prefix = "[dry run] " if dry_run else ""
+        self.stdout.write(f"{prefix}Moved {moved} files into blobs, removed {duplicates} duplicates "
+                          f"({saved_bytes / 1024 / 1024:.1f} MB saved).")
+        if missing:
+            self.stdout.write(self.style.WARNING(f"{missing} referenced files are missing on disk."))
+        if orphans:
+            action = "Deleted" if options['delete_orphans'] and not dry_run else "Found"
+            self.stdout.write(f"{action} {len(orphans)} unreferenced files ({orphan_bytes / 1024 / 1024:.1f} MB).")
+
+    def _link_blob(self, name, blob):
+        source, target = blob_storage.path(name), blob_storage.path(blob)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+    def _orphans(self, referenced):
+        """Files on disk outside the blob store that no row points to"""
+        root = blob_storage.location
+        blob_root = blob_storage.path(blob_storage.prefix)
+        orphans, size = [], 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            if dirpath == blob_root or dirpath.startswith(blob_root + os.sep):
+                dirnames[:] = []
+                continue
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                if name not in referenced:
+                    orphans.append(name)
+                    size += os.path.getsize(path)
+        return orphans, size
+
+    def _rebuild_counts(self):
+        """Recount every blob reference from the rows that hold them.
+
+        Counting and rewriting run in one transaction that keeps uploads and
+        deletes out until it commits, so none of them is lost in between. On
+        PostgreSQL the tables are locked up front (reads carry on); on SQLite
+        the delete takes the database write lock before anything is counted.
+        """
+        models = [MediaBlob] + [model for model, _ in BLOB_FIELDS]
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                tables = ', '.join(connection.ops.quote_name(model._meta.db_table) for model in dict.fromkeys(models))
+                with connection.cursor() as cursor:
+                    cursor.execute(f"LOCK TABLE {tables} IN SHARE ROW EXCLUSIVE MODE")
+            MediaBlob.objects.all().delete()
+            counts = Counter()
+            for model, field in BLOB_FIELDS:
+                rows = (
+                    model.objects.filter(**{f'{field}__startswith': f'{blob_storage.prefix}/'})
+                    .order_by().values(field).annotate(refs=Count('pk'))
+                )
+                for row in rows.iterator():
+                    counts[row[field]] += row['refs']
+            MediaBlob.objects.bulk_create(
+                [MediaBlob(name=name, ref_count=refs) for name, refs in counts.items()],
+                batch_size=1000,
+            )
@@ -0,0 +1,51 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Max, Sum
+
+from innercircle.models import Notification, Profile
+
+
+class Command(BaseCommand):
+    help = "Fold unread notifications of digest users into one digest notification each"
+
+    def handle(self, *args, **options):
+        user_ids = Profile.objects.filter(digest_notifications=True).values('user_id')
+        type_labels = dict(Notification.TYPES)
+
+        with transaction.atomic():
+            # Snapshot the newest id so rows created while we run are left for next time
+            cutoff = Notification.objects.aggregate(last_id=Max('id'))['last_id']
+            if cutoff is None:
+                self.stdout.write("No notifications to digest.")
+                return
+
+            pending = Notification.objects.filter(
+                user_id__in=user_ids, read=False, id__lte=cutoff
+            ).exclude(notification_type='digest')
+
+            totals = defaultdict(list)
+            rows = (
+                pending.order_by()
+                .values('user_id', 'notification_type')
+                .annotate(events=Sum('actor_count'))
+                .order_by('user_id', 'notification_type')
+            )
+            for row in rows:
+                label = type_labels[row['notification_type']]
+                totals[row['user_id']].append(f"{label} ×{row['events']}")
+
+            Notification.objects.bulk_create([
+                Notification(
+                    user_id=user_id,
+                    notification_type='digest',
+                    text=f"Your digest: {', '.join(parts)}"[:255],
+                )
+                for user_id, parts in totals.items()
+            ])
+            folded, _ = pending.delete()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Sent {len(totals)} digests, folding {folded} notifications."
+        ))
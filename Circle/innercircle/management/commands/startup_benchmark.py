@@ -0,0 +1,91 @@
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)$')
+
+# Importing config.wsgi alone never loads the URLconf or the views, so the
+# application targets also build the resolver, as the first request would
+LOAD_URLCONF = "from django.urls import get_resolver; get_resolver().url_patterns"
+FIRST_REQUEST = (
+    "from wsgiref.util import setup_testing_defaults; from config.wsgi import application; "
+    "environ = {{'PATH_INFO': {path!r}}}; setup_testing_defaults(environ); "
+    "b''.join(application(environ, lambda status, headers: None))"
+)
+
+
+class Command(BaseCommand):
+    help = "Measure cold start of manage.py, the WSGI/ASGI apps and a first request, plus import cost per module"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help="Cold starts per target")
+        parser.add_argument('--top', type=int, default=15, help="Modules to list by cumulative import time")
+        parser.add_argument('--path', default='/login/', help="Path served by the first-request target")
+        parser.add_argument('--json', action='store_true', help="Print machine-readable results")
+
+    def handle(self, *args, **options):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'config.settings')}
+        cwd = str(settings.BASE_DIR)
+        first_request = FIRST_REQUEST.format(path=options['path'])
+        targets = {
+            'python': [sys.executable, '-c', 'pass'],
+            'manage.py check': [sys.executable, 'manage.py', 'check'],
+            'wsgi': [sys.executable, '-c', f'import config.wsgi; {LOAD_URLCONF}'],
+            'asgi': [sys.executable, '-c', f'import config.asgi; {LOAD_URLCONF}'],
+            'first request': [sys.executable, '-c', first_request],
+        }
+
+        startup = {}
+        for label, command in targets.items():
+            timings = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                subprocess.run(command, cwd=cwd, env=env, check=True, capture_output=True)
+                timings.append((time.perf_counter() - started) * 1000)
+            startup[label] = {'median_ms': statistics.median(timings), 'min_ms': min(timings)}
+
+        packages, modules = self._import_costs(first_request, cwd, env)
+        results = {
+            'settings': env['DJANGO_SETTINGS_MODULE'],
+            'startup': startup,
+            'import_self_ms_by_package': dict(packages.most_common()),
+            'import_cumulative_ms_by_module': dict(modules.most_common(options['top'])),
+        }
+
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        self.stdout.write(f"Cold start ({options['repeat']} runs, settings={results['settings']})")
+        for label, timing in startup.items():
+            self.stdout.write(f"  {label:<18} median {timing['median_ms']:8.1f} ms   min {timing['min_ms']:8.1f} ms")
+        self.stdout.write(f"\nImport self time by top-level package (first request to {options['path']})")
+        for package, ms in packages.most_common(options['top']):
+            self.stdout.write(f"  {package:<30} {ms:8.1f} ms")
+        self.stdout.write("\nSlowest modules by cumulative import time")
+        for module, ms in modules.most_common(options['top']):
+            self.stdout.write(f"  {module:<50} {ms:8.1f} ms")
+
+    def _import_costs(self, code, cwd, env):
+        """Parse ``python -X importtime`` for running ``code``"""
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=cwd, env=env, check=True, capture_output=True, text=True,
+        )
+        packages, modules = Counter(), Counter()
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_RE.match(line)
+            if not match:
+                continue
+            self_us, cumulative_us, _, module = match.groups()
+            packages[module.split('.')[0]] += int(self_us) / 1000
+            modules[module] = int(cumulative_us) / 1000
+        return packages, modules
@@ -1,16 +1,45 @@
+import hashlib
+import threading
+from collections import Counter
+from functools import partial
+
 from django.conf import settings
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, OuterRef
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 from django.utils import timezone
 
+from .storage import blob_storage, get_blob_storage
+
 User = get_user_model()
 
 
+def hash_email(email):
+    """SHA-256 of the normalised address, used for indexed contact matching"""
+    return hashlib.sha256(email.strip().lower().encode()).hexdigest()
+
+
+class SubqueryCount(models.Subquery):
+    """COUNT(*) of a correlated subquery, avoiding JOIN fan-out when annotating several counts"""
+    template = "(SELECT COUNT(*) FROM (%(subquery)s) _count)"
+    output_field = models.IntegerField()
+
+    def __init__(self, queryset, **extra):
+        super().__init__(queryset.order_by().values('pk'), **extra)
+
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
-    avatar = models.ImageField(upload_to='avatars/', blank=True, null=True, help_text="Profile picture (PNG/JPG)")
+    avatar = models.ImageField(
+        upload_to='avatars/', storage=get_blob_storage, blank=True, null=True, help_text="Profile picture (PNG/JPG)"
+    )
     bio = models.TextField(blank=True, max_length=500, help_text="Brief bio (max 500 chars)")
+    digest_notifications = models.BooleanField(
+        default=False,
+        help_text="Fold unread notifications into a periodic digest"
+    )
+    email_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -21,17 +50,35 @@ class Profile(models.Model):
     def __str__(self):
         return f"{self.user.username}'s Profile"
 
+    def save(self, *args, **kwargs):
+        self.email_hash = hash_email(self.user.email) if self.user.email else ''
+        super().save(*args, **kwargs)
+
     def get_friends_count(self):
         """Count confirmed friendships"""
+        if hasattr(self, 'friends_count'):
+            return self.friends_count
         return FriendRequest.objects.filter(
             models.Q(from_user=self.user, accepted=True) | models.Q(to_user=self.user, accepted=True)
         ).count()
 
     def get_items_count(self):
         """Count items posted"""
+        if hasattr(self, 'items_count'):
+            return self.items_count
         return self.user.items.count()
 
 
+class ItemQuerySet(models.QuerySet):
+    def with_swap_state(self, user):
+        """Annotate pending_request_count and requested_by_me without loading swap rows"""
+        swaps = SwapRequest.objects.filter(item=OuterRef('pk'))
+        return self.annotate(
+            pending_request_count=SubqueryCount(swaps.filter(status='pending')),
+            requested_by_me=models.Exists(swaps.filter(sender=user, status__in=SwapRequest.ACTIVE_STATUSES)),
+        )
+
+
 class Item(models.Model):
     CATEGORY_CHOICES = [
         ('tops', 'Tops'),
@@ -60,18 +107,28 @@ class Item(models.Model):
     title = models.CharField(max_length=200, db_index=True)
     description = models.TextField(blank=True, max_length=1000)
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
-    updated_at = models.DateTimeField(auto_now=True)
-    photo = models.ImageField(upload_to='items/%Y/%m/', blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    photo = models.ImageField(upload_to='items/%Y/%m/', storage=get_blob_storage, blank=True, null=True)
     category = models.CharField(max_length=20, choices=CATEGORY_CHOICES, default='other')
     size = models.CharField(max_length=5, choices=SIZE_CHOICES, blank=True)
     condition = models.CharField(max_length=10, choices=CONDITION_CHOICES, default='good')
-    is_available = models.BooleanField(default=True, db_index=True)
+    is_available = models.BooleanField(default=True)
+
+    objects = ItemQuerySet.as_manager()
 
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['owner', '-created_at']),
-            models.Index(fields=['category', 'is_available']),
+            # Partial indexes: only the hot (available) rows are indexed
+            models.Index(
+                fields=['owner', '-created_at'], condition=models.Q(is_available=True),
+                name='item_available_owner_idx',
+            ),
+            models.Index(
+                fields=['category'], condition=models.Q(is_available=True),
+                name='item_available_category_idx',
+            ),
         ]
         verbose_name_plural = "Items"
 
@@ -88,7 +145,7 @@ class FriendRequest(models.Model):
     to_user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='received_friend_requests')
     message = models.CharField(max_length=255, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
-    accepted = models.BooleanField(default=False, db_index=True)
+    accepted = models.BooleanField(default=False)
     accepted_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
@@ -96,12 +153,30 @@ class FriendRequest(models.Model):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['to_user', 'accepted']),
+            models.Index(
+                fields=['to_user', '-created_at'], condition=models.Q(accepted=False),
+                name='friendreq_pending_to_idx',
+            ),
+            models.Index(
+                fields=['from_user', '-created_at'], condition=models.Q(accepted=False),
+                name='friendreq_pending_from_idx',
+            ),
         ]
 
     def __str__(self):
         status = "✓ Accepted" if self.accepted else "✗ Pending"
         return f"{self.from_user} → {self.to_user} [{status}]"
 
+    @classmethod
+    def friend_ids(cls, user):
+        """Ids of the user's confirmed friends"""
+        pairs = cls.objects.filter(
+            models.Q(from_user=user, accepted=True) | models.Q(to_user=user, accepted=True)
+        ).values_list('from_user', 'to_user')
+        friends = {user_id for pair in pairs for user_id in pair}
+        friends.discard(user.id)
+        return friends
+
     def accept(self):
         """Accept friend request and create reciprocal friendship"""
         self.accepted = True
@@ -129,13 +204,22 @@ class SwapRequest(models.Model):
     message = models.TextField(blank=True, max_length=500)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', db_index=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    accepted_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    completed_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    ACTIVE_STATUSES = ('pending', 'accepted')
+    FINISHED_STATUSES = ('completed', 'cancelled')
 
     class Meta:
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['receiver', 'status']),
             models.Index(fields=['sender', 'status']),
+            models.Index(
+                fields=['item'], condition=models.Q(status='pending'),
+                name='swap_pending_item_idx',
+            ),
         ]
 
     def __str__(self):
@@ -144,6 +228,7 @@ class SwapRequest(models.Model):
     def accept(self):
         """Accept swap request"""
         self.status = 'accepted'
+        self.accepted_at = timezone.now()
         self.save()
         Notification.objects.create(
             user=self.sender,
@@ -154,6 +239,7 @@ class SwapRequest(models.Model):
     def complete(self):
         """Mark swap as completed"""
         self.status = 'completed'
+        self.completed_at = timezone.now()
         self.item.is_available = False
         self.item.save()
         self.save()
@@ -164,17 +250,96 @@ class SwapRequest(models.Model):
         self.save()
 
 
+class NotificationManager(models.Manager):
+    # (single, grouped) text per coalescible notification type
+    GROUPED_TEXTS = {
+        'friend_request': (
+            "{actor} sent you a friend request",
+            "{actor} and {others} sent you friend requests",
+        ),
+        'swap_request': (
+            "{actor} requested {target}",
+            "{actor} and {others} requested {target}",
+        ),
+    }
+
+    def _texts(self, notification_type):
+        texts = self.GROUPED_TEXTS.get(notification_type)
+        if texts is None:
+            raise ValueError(f"{notification_type!r} notifications cannot be grouped")
+        return texts
+
+    def _fold(self, notification, actor, target_label):
+        """Add another actor to an unread notification and rewrite its text"""
+        _, grouped = self._texts(notification.notification_type)
+        notification.actor_count += 1
+        others = notification.actor_count - 1
+        notification.text = grouped.format(
+            actor=actor.username,
+            others=f"{others} other{'s' if others != 1 else ''}",
+            target=target_label,
+        )[:255]
+        notification.created_at = timezone.now()
+
+    def notify(self, user, notification_type, actor, target_key='', target_label=''):
+        """Create a notification, folding it into an unread one for the same target"""
+        single, _ = self._texts(notification_type)
+
+        with transaction.atomic():
+            existing = self.select_for_update().filter(
+                user=user,
+                notification_type=notification_type,
+                target_key=target_key,
+                read=False,
+            ).first()
+            if existing is None:
+                return self.create(
+                    user=user,
+                    notification_type=notification_type,
+                    target_key=target_key,
+                    text=single.format(actor=actor.username, target=target_label),
+                )
+            self._fold(existing, actor, target_label)
+            existing.save(update_fields=['actor_count', 'text', 'created_at'])
+            return existing
+
+    def notify_many(self, user_ids, notification_type, actor, target_key='', target_label=''):
+        """notify() for many recipients at once: one bulk_update plus one bulk_create"""
+        single, _ = self._texts(notification_type)
+
+        with transaction.atomic():
+            existing = list(self.select_for_update().filter(
+                user_id__in=user_ids,
+                notification_type=notification_type,
+                target_key=target_key,
+                read=False,
+            ))
+            for notification in existing:
+                self._fold(notification, actor, target_label)
+            self.bulk_update(existing, ['actor_count', 'text', 'created_at'])
+
+            folded = {notification.user_id for notification in existing}
+            text = single.format(actor=actor.username, target=target_label)
+            self.bulk_create([
+                self.model(user_id=user_id, notification_type=notification_type, target_key=target_key, text=text)
+                for user_id in user_ids if user_id not in folded
+            ])
+
+
 class Notification(models.Model):
     TYPES = [
         ('friend_request', 'Friend Request'),
         ('request_accepted', 'Request Accepted'),
         ('swap_request', 'Swap Request'),
         ('swap_accepted', 'Swap Accepted'),
+        ('digest', 'Digest'),
     ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='notifications')
     text = models.CharField(max_length=255)
     notification_type = models.CharField(max_length=20, choices=TYPES, default='swap_request')
+    target_key = models.CharField(max_length=50, blank=True, help_text="Groups notifications about the same object")
+    actor_count = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
     read = models.BooleanField(default=False, db_index=True)
     read_at = models.DateTimeField(null=True, blank=True)
@@ -183,8 +348,14 @@ class Notification(models.Model):
         ordering = ['-created_at']
         indexes = [
             models.Index(fields=['user', 'read', '-created_at']),
+            models.Index(
+                fields=['user', 'notification_type', 'target_key'], condition=models.Q(read=False),
+                name='notif_unread_target_idx',
+            ),
         ]
 
+    objects = NotificationManager()
+
     def __str__(self):
         status = "📖 Read" if self.read else "📧 Unread"
         return f"{self.user.username}: {self.text} [{status}]"
@@ -195,3 +366,178 @@ class Notification(models.Model):
             self.read = True
             self.read_at = timezone.now()
             self.save()
+
+
+class ArchivedItem(models.Model):
+    """Cold copy of an item that has been unavailable for a long time"""
+    original_id = models.BigIntegerField(unique=True)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_items')
+    title = models.CharField(max_length=200, db_index=True)
+    description = models.TextField(blank=True, max_length=1000)
+    photo = models.ImageField(upload_to='items/%Y/%m/', storage=get_blob_storage, blank=True, null=True)
+    category = models.CharField(max_length=20, choices=Item.CATEGORY_CHOICES, default='other')
+    size = models.CharField(max_length=5, choices=Item.SIZE_CHOICES, blank=True)
+    condition = models.CharField(max_length=10, choices=Item.CONDITION_CHOICES, default='good')
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['owner', '-created_at']),
+        ]
+        verbose_name_plural = "Archived items"
+
+    def __str__(self):
+        return f"{self.title} (archived) - {self.owner_id}"
+
+
+class ArchivedSwapRequest(models.Model):
+    """Cold copy of a completed or cancelled swap request"""
+    original_id = models.BigIntegerField(unique=True)
+    sender = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_sent_swap_requests')
+    receiver = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_received_swap_requests')
+    # Plain ids: the item may live in either the hot or the archive table
+    original_item_id = models.BigIntegerField(db_index=True)
+    item_title = models.CharField(max_length=200, db_index=True)
+    message = models.TextField(blank=True, max_length=500)
+    status = models.CharField(max_length=20, choices=SwapRequest.STATUS_CHOICES)
+    created_at = models.DateTimeField()
+    updated_at = models.DateTimeField()
+    accepted_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['receiver', '-created_at']),
+            models.Index(fields=['sender', '-created_at']),
+        ]
+        verbose_name_plural = "Archived swap requests"
+
+    def __str__(self):
+        return f"{self.sender_id} → {self.receiver_id} | {self.item_title} [{self.get_status_display()}]"
+
+
+class MetricRollupManager(models.Manager):
+    def add(self, metric, period, dimension, value):
+        """Increment a rollup cell, creating it on first use"""
+        if self.filter(metric=metric, period=period, dimension=dimension).update(value=F('value') + value):
+            return
+        try:
+            with transaction.atomic():
+                self.create(metric=metric, period=period, dimension=dimension, value=value)
+        except IntegrityError:
+            self.filter(metric=metric, period=period, dimension=dimension).update(value=F('value') + value)
+
+
+class MetricRollup(models.Model):
+    """Pre-aggregated analytics counter for one metric, week and dimension"""
+    metric = models.CharField(max_length=50)
+    period = models.DateField(help_text="First day of the week")
+    dimension = models.CharField(max_length=50, blank=True)
+    value = models.BigIntegerField(default=0)
+
+    objects = MetricRollupManager()
+
+    class Meta:
+        ordering = ['metric', 'period', 'dimension']
+        unique_together = ('metric', 'period', 'dimension')
+
+    def __str__(self):
+        return f"{self.metric} {self.period} {self.dimension}: {self.value}"
+
+
+class AnalyticsCheckpoint(models.Model):
+    """How far an incremental analytics job has processed"""
+    name = models.CharField(max_length=50, unique=True)
+    position = models.DateTimeField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.position}"
+
+
+# Blobs referenced by an upload in this thread whose row hasn't been saved yet
+_uploads = threading.local()
+
+
+def _pending_uploads():
+    if not hasattr(_uploads, 'names'):
+        _uploads.names = Counter()
+    return _uploads.names
+
+
+class MediaBlobManager(models.Manager):
+    def retain_upload(self, name):
+        """Reference a blob while its upload is being stored.
+
+        Called by the storage before it checks for the file, so a concurrent
+        release can't delete the blob between the check and the row being
+        saved. The reference is then used up by the ``retain`` for that row.
+        """
+        self.retain([name])
+        _pending_uploads()[name] += 1
+
+    def retain(self, names):
+        """Add one reference per name (repeats count once each)"""
+        pending = _pending_uploads()
+        for name in names:
+            if not blob_storage.is_blob(name):
+                continue
+            if pending[name]:
+                pending[name] -= 1
+                if not pending[name]:
+                    del pending[name]
+                continue
+            if self.filter(name=name).update(ref_count=F('ref_count') + 1):
+                continue
+            try:
+                with transaction.atomic():
+                    self.create(name=name, ref_count=1)
+            except IntegrityError:
+                self.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    def release(self, names):
+        """Drop one reference per name and delete blobs nobody uses any more"""
+        names = [name for name in names if blob_storage.is_blob(name)]
+        if not names:
+            return
+        with transaction.atomic():
+            for name in names:
+                self.filter(name=name).update(ref_count=F('ref_count') - 1)
+            orphans = self.filter(name__in=names, ref_count__lte=0).values_list('name', flat=True)
+            for name in orphans:
+                transaction.on_commit(partial(self._delete_unreferenced, name))
+
+    def _delete_unreferenced(self, name):
+        # The row stays until the file is gone: an upload of the same content
+        # retains it first, so it either waits on this lock and writes the
+        # file again, or gets in before and the blob is kept
+        with transaction.atomic():
+            blob = self.select_for_update().filter(name=name).first()
+            if blob is not None and blob.ref_count <= 0:
+                blob_storage.delete(name)
+                blob.delete()
+
+
+class MediaBlob(models.Model):
+    """Reference count of a content-addressed media file"""
+    name = models.CharField(max_length=255, unique=True)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = MediaBlobManager()
+
+    def __str__(self):
+        return f"{self.name} ({self.ref_count} refs)"
+
+
+# File fields stored in blob_storage, whose references MediaBlob counts
+BLOB_FIELDS = (
+    (Item, 'photo'),
+    (ArchivedItem, 'photo'),
+    (Profile, 'avatar'),
+)
@@ -0,0 +1,138 @@
+"""Affinity-ranked ordering for the friends feed.
+
+The newest ``CANDIDATE_WINDOW`` feed items are scored on four features:
+recency decay, viewer-owner affinity (past swaps plus mutual friends), and
+how well the item's category and size match the viewer's own items and
+requests. The per-user affinity data is cached. Once it is older than
+``AFFINITY_REFRESH`` seconds it is rebuilt on a background thread while the
+stale copy keeps serving.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count
+
+from .models import ArchivedSwapRequest, FriendRequest, Item, SwapRequest
+from .similarity import CATEGORY_CODES, SIZE_CODES
+
+logger = logging.getLogger(__name__)
+
+CANDIDATE_WINDOW = 300
+RECENCY_HALF_LIFE_HOURS = 48
+# recency, owner affinity, category match, size match
+WEIGHTS = np.array([1.0, 0.8, 0.4, 0.2])
+
+AFFINITY_TTL = 6 * 3600
+AFFINITY_REFRESH = 30 * 60
+
+
+def _normalised(counter):
+    top = max(counter.values(), default=0)
+    return {key: value / top for key, value in counter.items()} if top else {}
+
+
+def _preference_vector(counter, codes):
+    """Normalised preference per choice code; index 0 is 'unknown'"""
+    vector = [0.0] * (len(codes) + 1)
+    for key, weight in _normalised(counter).items():
+        vector[codes.get(key, 0)] = weight
+    return vector
+
+
+def build_affinity(user):
+    friend_ids = FriendRequest.friend_ids(user)
+
+    exchanges = Counter()
+    active_swaps = SwapRequest.objects.exclude(status='cancelled')
+    past_swaps = ArchivedSwapRequest.objects.filter(status='completed')
+    for swaps in (active_swaps, past_swaps):
+        for partner, total in swaps.filter(sender=user).values_list('receiver').annotate(n=Count('pk')).order_by():
+            exchanges[partner] += total
+        for partner, total in swaps.filter(receiver=user).values_list('sender').annotate(n=Count('pk')).order_by():
+            exchanges[partner] += total
+
+    # Friendships inside the viewer's circle: each one is a mutual friend for both ends
+    mutual = Counter()
+    circle = FriendRequest.objects.filter(accepted=True, from_user__in=friend_ids, to_user__in=friend_ids)
+    for from_id, to_id in circle.values_list('from_user', 'to_user').iterator():
+        mutual[from_id] += 1
+        mutual[to_id] += 1
+
+    owners = Counter()
+    for owner_id in friend_ids:
+        owners[owner_id] = math.log1p(exchanges[owner_id]) + 0.5 * math.log1p(mutual[owner_id])
+
+    categories, sizes = Counter(), Counter()
+    own_items = Item.objects.filter(owner=user).order_by()
+    requested = SwapRequest.objects.filter(sender=user).order_by()
+    for category, total in own_items.values_list('category').annotate(n=Count('pk')):
+        categories[category] += total
+    for category, total in requested.values_list('item__category').annotate(n=Count('pk')):
+        categories[category] += total
+    for size, total in own_items.values_list('size').annotate(n=Count('pk')):
+        sizes[size] += total
+    for size, total in requested.values_list('item__size').annotate(n=Count('pk')):
+        sizes[size] += total
+
+    return {
+        'owners': _normalised(owners),
+        'categories': _preference_vector(categories, CATEGORY_CODES),
+        'sizes': _preference_vector(sizes, SIZE_CODES),
+        'built_at': time.time(),
+    }
+
+
+def _cache_key(user_id):
+    return f'feed_affinity:{user_id}'
+
+
+def _refresh(user):
+    try:
+        cache.set(_cache_key(user.pk), build_affinity(user), AFFINITY_TTL)
+    except Exception:
+        logger.exception("Refreshing feed affinity for user %s failed", user.pk)
+    finally:
+        cache.delete(_cache_key(user.pk) + ':refreshing')
+        # This thread's connections are never reused, so don't leave them open
+        connections.close_all()
+
+
+def get_affinity(user):
+    affinity = cache.get(_cache_key(user.pk))
+    if affinity is None:
+        affinity = build_affinity(user)
+        cache.set(_cache_key(user.pk), affinity, AFFINITY_TTL)
+    elif time.time() - affinity['built_at'] > AFFINITY_REFRESH:
+        # cache.add is the lock: only one worker refreshes a given user
+        if cache.add(_cache_key(user.pk) + ':refreshing', True, 300):
+            threading.Thread(target=_refresh, args=(user,), daemon=True).start()
+    return affinity
+
+
+def rank_feed(user, queryset):
+    """Ids from the newest CANDIDATE_WINDOW items of ``queryset``, best first"""
+    rows = list(
+        queryset.order_by('-created_at').values_list('id', 'owner_id', 'created_at', 'category', 'size')
+        [:CANDIDATE_WINDOW]
+    )
+    if not rows:
+        return []
+    affinity = get_affinity(user)
+    owner_affinity = affinity['owners']
+    ids, owners, created, categories, sizes = zip(*rows)
+
+    age_hours = (time.time() - np.fromiter((c.timestamp() for c in created), float, len(rows))) / 3600
+    features = np.column_stack([
+        np.exp2(-age_hours / RECENCY_HALF_LIFE_HOURS),
+        np.fromiter((owner_affinity.get(owner, 0.0) for owner in owners), float, len(rows)),
+        np.asarray(affinity['categories'])[[CATEGORY_CODES.get(c, 0) for c in categories]],
+        np.asarray(affinity['sizes'])[[SIZE_CODES.get(s, 0) for s in sizes]],
+    ])
+    order = np.argsort(-(features @ WEIGHTS), kind='stable')
+    return [ids[i] for i in order]
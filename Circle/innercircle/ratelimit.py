@@ -0,0 +1,244 @@
+"""Token-bucket rate limiting for write endpoints and login.
+
+Limits are configured per URL name in ``settings.RATELIMITS``::
+
+    RATELIMITS = {
+        'login': {'rate': '10/m', 'key': 'ip', 'methods': ['POST']},
+        'request_create': {'rate': '30/h'},
+    }
+
+``rate`` is ``"<requests>/<s|m|h|d>"``: the bucket holds that many tokens and
+refills evenly over the period. ``key`` is ``'user'`` (the default, falls back
+to the client IP for anonymous requests) or ``'ip'``. ``methods`` defaults to
+every method.
+
+``RateLimitMiddleware`` enforces the table before the view runs. The
+``ratelimit`` decorator applies an explicit limit to a single view. Rejected
+requests get a plain 429 with ``Retry-After``.
+"""
+import hashlib
+import time
+from functools import wraps
+from itertools import islice
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+
+def parse_rate(rate):
+    """'30/h' -> (30, 3600)"""
+    count, period = rate.split('/')
+    return int(count), PERIODS[period]
+
+
+def _take(tokens, stamp, now, capacity, period):
+    """Refill since ``stamp`` and take one token: (tokens left, seconds to wait)"""
+    tokens = min(capacity, tokens + (now - stamp) * capacity / period)
+    if tokens < 1:
+        return tokens, (1 - tokens) * period / capacity
+    return tokens - 1, 0
+
+
+class LocalMemoryBackend:
+    """Per-process buckets in a plain dict.
+
+    No lock: each bucket is a tuple swapped in with one dict assignment, which
+    is atomic under the GIL. Concurrent hits on the same key can occasionally
+    both spend the same token, which is acceptable for throttling.
+
+    Every hit moves its key to the end of the dict, so the front holds the
+    least recently used buckets. Past ``max_entries`` the oldest are dropped
+    down to ``low_water`` in one go, which keeps the cost constant per hit
+    even when a flood of distinct keys never refills.
+    """
+    max_entries = 50000
+    low_water = 0.9
+
+    def __init__(self):
+        self._buckets = {}
+
+    def consume(self, key, capacity, period):
+        """Take one token; return 0 if allowed, else seconds until one is available"""
+        now = time.monotonic()
+        tokens, stamp = self._buckets.pop(key, None) or (capacity, now)
+        tokens, wait = _take(tokens, stamp, now, capacity, period)
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.max_entries:
+            self._evict()
+        return wait
+
+    async def aconsume(self, key, capacity, period):
+        # No I/O, so there is nothing to hand off to a thread
+        return self.consume(key, capacity, period)
+
+    def _evict(self):
+        excess = len(self._buckets) - int(self.max_entries * self.low_water)
+        for key in list(islice(self._buckets, excess)):
+            self._buckets.pop(key, None)
+
+
+class CacheBackend:
+    """Buckets in a Django cache shared by all workers (e.g. Redis or Memcached).
+
+    The read-modify-write is not atomic, so a burst across workers can slightly
+    overshoot the limit.
+    """
+
+    def __init__(self, alias='default'):
+        self.cache = caches[alias]
+
+    def consume(self, key, capacity, period):
+        now = time.time()
+        cache_key = f'ratelimit:{key}'
+        tokens, stamp = self.cache.get(cache_key, (capacity, now))
+        tokens, wait = _take(tokens, stamp, now, capacity, period)
+        self.cache.set(cache_key, (tokens, now), timeout=period)
+        return wait
+
+    async def aconsume(self, key, capacity, period):
+        now = time.time()
+        cache_key = f'ratelimit:{key}'
+        tokens, stamp = await self.cache.aget(cache_key, (capacity, now))
+        tokens, wait = _take(tokens, stamp, now, capacity, period)
+        await self.cache.aset(cache_key, (tokens, now), timeout=period)
+        return wait
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        if getattr(settings, 'RATELIMIT_BACKEND', 'local') == 'cache':
+            _backend = CacheBackend(getattr(settings, 'RATELIMIT_CACHE', 'default'))
+        else:
+            _backend = LocalMemoryBackend()
+    return _backend
+
+
+def client_ip(request):
+    if getattr(settings, 'RATELIMIT_TRUST_X_FORWARDED_FOR', False):
+        forwarded = request.META.get('HTTP_X_FORWARDED_FOR')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def _session_key(request):
+    """Bucket key for the session cookie, read without loading the session"""
+    cookie = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if cookie:
+        return 'session:' + hashlib.blake2b(cookie.encode(), digest_size=12).hexdigest()
+    return None
+
+
+def _user_key(request, user):
+    return f'user:{user.pk}' if user.is_authenticated else f'ip:{client_ip(request)}'
+
+
+def _too_many(wait):
+    response = HttpResponse("Too many requests. Please slow down.", status=429, content_type='text/plain')
+    response['Retry-After'] = str(int(wait) + 1)
+    return response
+
+
+def check(request, group, rate, key='user', methods=None):
+    """Return a 429 response if the request is over its limit, else None.
+
+    With ``key='user'`` a client with a session cookie is first checked
+    against a bucket for that cookie, so while it is over its limit no
+    session load or auth query runs. ``request.user`` is only resolved once
+    that check passes, and the view needs it then anyway. The user's own
+    bucket still applies to users spreading requests across sessions.
+    """
+    if methods and request.method not in methods:
+        return None
+    capacity, period = parse_rate(rate)
+    backend = get_backend()
+    session = _session_key(request) if key == 'user' else None
+    if session is None:
+        wait = backend.consume(f'{group}:ip:{client_ip(request)}', capacity, period)
+        return _too_many(wait) if wait else None
+    wait = backend.consume(f'{group}:{session}', capacity, period)
+    if not wait:
+        wait = backend.consume(f'{group}:{_user_key(request, request.user)}', capacity, period)
+    return _too_many(wait) if wait else None
+
+
+async def acheck(request, group, rate, key='user', methods=None):
+    """check() for async requests: no thread hop unless the user must be resolved"""
+    if methods and request.method not in methods:
+        return None
+    capacity, period = parse_rate(rate)
+    backend = get_backend()
+    session = _session_key(request) if key == 'user' else None
+    if session is None:
+        wait = await backend.aconsume(f'{group}:ip:{client_ip(request)}', capacity, period)
+        return _too_many(wait) if wait else None
+    wait = await backend.aconsume(f'{group}:{session}', capacity, period)
+    if not wait:
+        # Resolves the lazy user off the event loop (request.auser() needs Django 5)
+        user_key = await sync_to_async(_user_key)(request, request.user)
+        wait = await backend.aconsume(f'{group}:{user_key}', capacity, period)
+    return _too_many(wait) if wait else None
+
+
+def ratelimit(rate, key='user', methods=None, group=None):
+    """Throttle a single view, e.g. ``@ratelimit('5/m', key='ip', methods=['POST'])``"""
+    def decorator(view_func):
+        bucket = group or view_func.__name__
+
+        @wraps(view_func)
+        def _wrapped(request, *args, **kwargs):
+            limited = check(request, bucket, rate, key, methods)
+            if limited is not None:
+                return limited
+            return view_func(request, *args, **kwargs)
+        return _wrapped
+    return decorator
+
+
+class RateLimitMiddleware:
+    """Apply ``settings.RATELIMITS`` by URL name before the view runs.
+
+    Works in both handler modes, so ASGI requests aren't pushed through a
+    thread just for the limit check.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limits = getattr(settings, 'RATELIMITS', {})
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+            self.process_view = self.aprocess_view
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        return await self.get_response(request)
+
+    def _limit(self, request):
+        url_name = request.resolver_match.url_name if request.resolver_match else None
+        return url_name, self.limits.get(url_name)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        url_name, limit = self._limit(request)
+        if limit is None:
+            return None
+        return check(request, url_name, limit['rate'], limit.get('key', 'user'), limit.get('methods'))
+
+    async def aprocess_view(self, request, view_func, view_args, view_kwargs):
+        url_name, limit = self._limit(request)
+        if limit is None:
+            return None
+        return await acheck(request, url_name, limit['rate'], limit.get('key', 'user'), limit.get('methods'))
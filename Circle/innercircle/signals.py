@@ -0,0 +1,68 @@
+import sys
+
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from .models import BLOB_FIELDS, Item, MediaBlob, Profile, hash_email
+
+
+@receiver(post_save, sender=Item)
+def update_similarity_index(sender, instance, **kwargs):
+    # No index can exist before the module is loaded; importing it here would
+    # pull numpy into every process that saves an item
+    similarity = sys.modules.get('innercircle.similarity')
+    if similarity is not None:
+        similarity.index_item(instance)
+
+
+@receiver(post_delete, sender=Item)
+def remove_from_similarity_index(sender, instance, **kwargs):
+    similarity = sys.modules.get('innercircle.similarity')
+    if similarity is not None:
+        similarity.unindex_item(instance.pk)
+
+
+@receiver(post_save, sender=get_user_model())
+def sync_email_hash(sender, instance, update_fields=None, **kwargs):
+    if update_fields is not None and 'email' not in update_fields:
+        return
+    email_hash = hash_email(instance.email) if instance.email else ''
+    Profile.objects.filter(user=instance).exclude(email_hash=email_hash).update(email_hash=email_hash)
+
+
+def _blob_names(instance):
+    # Read raw values from __dict__ so deferred fields aren't loaded
+    names = {}
+    for field in _fields_by_model[instance._meta.concrete_model]:
+        value = instance.__dict__.get(field)
+        names[field] = getattr(value, 'name', value) or ''
+    return names
+
+
+def remember_blobs(sender, instance, **kwargs):
+    instance._stored_blobs = _blob_names(instance)
+
+
+def count_blob_references(sender, instance, created, **kwargs):
+    old = {} if created else instance._stored_blobs
+    new = _blob_names(instance)
+    changed = [field for field, name in new.items() if name != old.get(field, '')]
+    if changed:
+        MediaBlob.objects.retain(new[field] for field in changed)
+        MediaBlob.objects.release([old.get(field, '') for field in changed])
+    instance._stored_blobs = new
+
+
+def release_blob_references(sender, instance, **kwargs):
+    MediaBlob.objects.release(list(_blob_names(instance).values()))
+
+
+_fields_by_model = {}
+for model, field in BLOB_FIELDS:
+    _fields_by_model.setdefault(model, []).append(field)
+
+for model in _fields_by_model:
+    post_init.connect(remember_blobs, sender=model, dispatch_uid=f'remember_blobs_{model.__name__}')
+    post_save.connect(count_blob_references, sender=model, dispatch_uid=f'count_blobs_{model.__name__}')
+    post_delete.connect(release_blob_references, sender=model, dispatch_uid=f'release_blobs_{model.__name__}')
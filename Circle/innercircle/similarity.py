@@ -0,0 +1,244 @@
+"""In-memory TF-IDF index for "similar items from your circle".
+
+Item text is hashed into a fixed number of dimensions so rows can be added,
+changed or removed without refitting a vocabulary. Only available items are
+indexed. Each process keeps its own copy. Local saves update it through
+signals, and writes from other workers are picked up with a periodic delta
+sync on ``updated_at``. Rows deleted elsewhere are dropped when a query
+returns them and the database no longer has them.
+
+The first lookup in a process builds the index on a background thread, and
+the panel stays empty until it is ready. Each item takes
+``SIMILAR_ITEMS_DIMENSIONS`` float32 values (2 KB at the default 512), so
+1M available items need about 2 GB per process. Lower the dimensions to
+trade accuracy for memory.
+"""
+import logging
+import re
+import threading
+import zlib
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import FriendRequest, Item
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'[a-z0-9]{2,}')
+
+CATEGORY_CODES = {key: code for code, (key, _) in enumerate(Item.CATEGORY_CHOICES, start=1)}
+SIZE_CODES = {key: code for code, (key, _) in enumerate(Item.SIZE_CHOICES, start=1)}
+
+CATEGORY_WEIGHT = 0.3
+SIZE_WEIGHT = 0.15
+
+ITEM_FIELDS = ('id', 'owner_id', 'title', 'description', 'category', 'size', 'is_available')
+
+
+class SimilarItemIndex:
+    """Hashed term-frequency matrix with document frequencies for IDF weighting"""
+
+    def __init__(self, dimensions=512, capacity=1024):
+        self.dimensions = dimensions
+        self._lock = threading.Lock()
+        self._rows = {}       # item id -> row
+        self._free = []       # rows of removed items, reused first
+        self._size = 0
+        self._ids = np.zeros(capacity, dtype=np.int64)
+        self._owners = np.zeros(capacity, dtype=np.int64)
+        self._categories = np.zeros(capacity, dtype=np.int16)
+        self._sizes = np.zeros(capacity, dtype=np.int16)
+        self._live = np.zeros(capacity, dtype=bool)
+        self._tf = np.zeros((capacity, dimensions), dtype=np.float32)
+        self._df = np.zeros(dimensions, dtype=np.float64)
+        self.synced_at = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def vectorize(self, title, description):
+        """Sublinear term frequencies of hashed tokens"""
+        tokens = TOKEN_RE.findall(f"{title} {description}".lower())
+        if not tokens:
+            return np.zeros(self.dimensions, dtype=np.float32)
+        buckets = [zlib.crc32(token.encode()) % self.dimensions for token in tokens]
+        counts = np.bincount(buckets, minlength=self.dimensions).astype(np.float32)
+        nonzero = counts > 0
+        counts[nonzero] = 1 + np.log(counts[nonzero])
+        return counts
+
+    def upsert(self, item_id, owner_id, title, description, category, size, is_available):
+        if not is_available:
+            self.remove(item_id)
+            return
+        vector = self.vectorize(title, description)
+        with self._lock:
+            row = self._rows.get(item_id)
+            if row is None:
+                row = self._allocate()
+                self._rows[item_id] = row
+            else:
+                self._df -= self._tf[row] > 0
+            self._ids[row] = item_id
+            self._owners[row] = owner_id
+            self._categories[row] = CATEGORY_CODES.get(category, 0)
+            self._sizes[row] = SIZE_CODES.get(size, 0)
+            self._live[row] = True
+            self._tf[row] = vector
+            self._df += vector > 0
+
+    def remove(self, item_id):
+        with self._lock:
+            row = self._rows.pop(item_id, None)
+            if row is None:
+                return
+            self._df -= self._tf[row] > 0
+            self._tf[row] = 0
+            self._live[row] = False
+            self._free.append(row)
+
+    def _allocate(self):
+        if self._free:
+            return self._free.pop()
+        if self._size == len(self._ids):
+            capacity = len(self._ids) * 2
+            for name in ('_ids', '_owners', '_categories', '_sizes', '_live'):
+                setattr(self, name, np.resize(getattr(self, name), capacity))
+            self._live[self._size:] = False
+            tf = np.zeros((capacity, self.dimensions), dtype=np.float32)
+            tf[:self._size] = self._tf[:self._size]
+            self._tf = tf
+        self._size += 1
+        return self._size - 1
+
+    def query(self, item, owner_ids, limit=6):
+        """Ids of the most similar live items owned by ``owner_ids``, best first"""
+        if not owner_ids:
+            return []
+        vector = self.vectorize(item.title, item.description)
+        category = CATEGORY_CODES.get(item.category, 0)
+        size = SIZE_CODES.get(item.size, 0)
+        owners = np.fromiter(owner_ids, dtype=np.int64, count=len(owner_ids))
+
+        with self._lock:
+            n = self._size
+            mask = self._live[:n] & np.isin(self._owners[:n], owners)
+            mask &= self._ids[:n] != item.id
+            rows = np.flatnonzero(mask)
+            if not rows.size:
+                return []
+            idf = (np.log((1 + len(self._rows)) / (1 + self._df)) + 1).astype(np.float32)
+            candidates = self._tf[rows] * idf
+            categories = self._categories[rows]
+            sizes = self._sizes[rows]
+            ids = self._ids[rows]
+
+        query = vector * idf
+        norms = np.linalg.norm(candidates, axis=1) * np.linalg.norm(query)
+        scores = (candidates @ query) / np.where(norms == 0, 1, norms)
+        scores += CATEGORY_WEIGHT * (categories == category)
+        if size:
+            scores += SIZE_WEIGHT * (sizes == size)
+
+        if rows.size > limit:
+            top = np.argpartition(-scores, limit)[:limit]
+        else:
+            top = np.arange(rows.size)
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return ids[top].tolist()
+
+    def load(self, queryset):
+        for values in queryset.values_list(*ITEM_FIELDS).iterator(chunk_size=2000):
+            self.upsert(*values)
+
+
+_index = None
+_index_lock = threading.Lock()  # guards the sync timestamp
+_build_lock = threading.Lock()  # only one background build at a time
+_building = False
+
+
+def _build_index():
+    available = Item.objects.filter(is_available=True)
+    # Sized up front, so a large table doesn't pay for capacity doubling
+    index = SimilarItemIndex(
+        getattr(settings, 'SIMILAR_ITEMS_DIMENSIONS', 512), capacity=available.count() + 1024
+    )
+    index.synced_at = timezone.now()
+    index.load(available)
+    return index
+
+
+def _build_in_background():
+    global _index, _building
+    try:
+        _index = _build_index()
+    except Exception:
+        logger.exception("Building the similar items index failed")
+    finally:
+        _building = False
+        connections.close_all()
+
+
+def get_index():
+    """Process-wide index, or None while the first build is still running.
+
+    The first call starts the build on a background thread, so no request
+    waits for the full-table read. After that the index is delta-synced
+    periodically; the load runs outside ``_index_lock``, so queries in other
+    threads carry on meanwhile.
+    """
+    global _building
+    if _index is None:
+        with _build_lock:
+            if _index is None and not _building:
+                _building = True
+                threading.Thread(target=_build_in_background, daemon=True).start()
+        return None
+
+    interval = timedelta(seconds=getattr(settings, 'SIMILAR_ITEMS_SYNC_SECONDS', 60))
+    with _index_lock:
+        now = timezone.now()
+        if now - _index.synced_at < interval:
+            return _index
+        # Small overlap so rows committed during the last sync aren't missed
+        since = _index.synced_at - timedelta(seconds=5)
+        _index.synced_at = now
+    _index.load(Item.objects.filter(updated_at__gte=since))
+    return _index
+
+
+def index_item(item):
+    if _index is not None:
+        _index.upsert(*(getattr(item, field) for field in ITEM_FIELDS))
+
+
+def unindex_item(item_id):
+    if _index is not None:
+        _index.remove(item_id)
+
+
+def similar_items(item, user, limit=6, attempts=3):
+    """Available items from the user's friends that resemble ``item``"""
+    friend_ids = FriendRequest.friend_ids(user)
+    if not friend_ids:
+        return []
+    index = get_index()
+    if index is None:
+        return []  # still building; the panel fills in on a later request
+    for _ in range(attempts):
+        ranked = index.query(item, friend_ids, limit)
+        if not ranked:
+            return []
+        items = Item.objects.filter(pk__in=ranked, is_available=True).select_related('owner').in_bulk()
+        # Deleted (or made unavailable) by another worker: the delta sync can't see those
+        stale = [item_id for item_id in ranked if item_id not in items]
+        if not stale:
+            break
+        for item_id in stale:
+            index.remove(item_id)
+    return [items[item_id] for item_id in ranked if item_id in items]
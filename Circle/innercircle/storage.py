@@ -0,0 +1,104 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, InMemoryStorage, storages
+from django.utils.functional import SimpleLazyObject
+
+
+class ContentAddressedMixin:
+    """Store each distinct upload once, named by the SHA-256 of its content.
+
+    The ``upload_to`` path is ignored apart from the file extension. Each save
+    adds a ``MediaBlob`` reference up front, and deleting the blob once nothing
+    references it is up to those reference counts.
+    """
+    prefix = 'blobs'
+    chunk_size = 64 * 1024
+
+    def blob_name(self, digest, ext=''):
+        return f"{self.prefix}/{digest[:2]}/{digest[2:4]}/{digest}{ext}"
+
+    def is_blob(self, name):
+        return bool(name) and name.startswith(f"{self.prefix}/")
+
+    def get_available_name(self, name, max_length=None):
+        # Identical content maps to the same name, so never add a suffix
+        return name
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        digest = hashlib.sha256()
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+            for chunk in content.chunks(self.chunk_size):
+                digest.update(chunk)
+                spool.write(chunk)
+            name = self.blob_name(digest.hexdigest(), ext)
+            self._retain(name)
+            if not self.exists(name):
+                spool.seek(0)
+                name = super()._save(name, File(spool))
+        return name
+
+    def _retain(self, name):
+        # Referenced before the existence check, so the blob can't be deleted
+        # between finding it in place and the row pointing at it being saved
+        from .models import MediaBlob
+        MediaBlob.objects.retain_upload(name)
+
+    def hash_file(self, name):
+        """Digest of a stored file, read in chunks"""
+        digest = hashlib.sha256()
+        with self.open(name, 'rb') as f:
+            for chunk in f.chunks(self.chunk_size):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+
+class ContentAddressedStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content-addressed blobs on the local filesystem.
+
+    Uploads are streamed to a temporary file beside the blobs while being
+    hashed, then renamed into place (or dropped, if the blob already exists).
+    """
+
+    def _save(self, name, content):
+        ext = os.path.splitext(name)[1].lower()
+        tmp_dir = self.path(os.path.join(self.prefix, 'tmp'))
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, 'wb') as tmp:
+                for chunk in content.chunks(self.chunk_size):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+
+            name = self.blob_name(digest.hexdigest(), ext)
+            self._retain(name)
+            path = self.path(name)
+            if os.path.exists(path):
+                os.unlink(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                if self.file_permissions_mode is not None:
+                    os.chmod(tmp_path, self.file_permissions_mode)
+                os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        return name
+
+
+class InMemoryContentAddressedStorage(ContentAddressedMixin, InMemoryStorage):
+    """Content-addressed blobs held in memory, for the test settings"""
+
+
+def get_blob_storage():
+    """The ``blobs`` entry of ``settings.STORAGES`` (a callable, so migrations stay portable)"""
+    return storages['blobs']
+
+
+blob_storage = SimpleLazyObject(get_blob_storage)
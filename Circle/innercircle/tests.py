@@ -0,0 +1,853 @@
+import sys
+import time
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.asgi import ASGIHandler
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.functional import SimpleLazyObject
+
+from innercircle import analytics, ranking, ratelimit, similarity
+from innercircle.admin import STALE_SWAP_DAYS, EstimatedCountPaginator
+from innercircle.forms import ContactMatchForm
+from innercircle.management.commands import dedupe_media
+from innercircle.models import (
+    AnalyticsCheckpoint, ArchivedItem, ArchivedSwapRequest, FriendRequest, Item, MediaBlob, MetricRollup, Notification,
+    Profile, SwapRequest,
+)
+from innercircle.ratelimit import LocalMemoryBackend, RateLimitMiddleware, parse_rate
+from innercircle.similarity import CATEGORY_CODES, SIZE_CODES, SimilarItemIndex
+from innercircle.storage import blob_storage
+
+User = get_user_model()
+
+
+class AsyncViewContextMixin:
+    """The async views must render the context the sync versions did"""
+
+    def create_fixtures(self):
+        self.me = User.objects.create_user('me', password='pw')
+        self.friend = User.objects.create_user('friend')
+        self.stranger = User.objects.create_user('stranger')
+        for user in (self.me, self.friend, self.stranger):
+            Profile.objects.create(user=user)
+        FriendRequest.objects.create(from_user=self.friend, to_user=self.me, accepted=True)
+        self.incoming_request = FriendRequest.objects.create(from_user=self.stranger, to_user=self.me)
+        self.my_item = Item.objects.create(owner=self.me, title="Mine")
+        Item.objects.create(owner=self.me, title="Gone", is_available=False)
+        friend_item = Item.objects.create(owner=self.friend, title="Theirs")
+        self.sent_swap = SwapRequest.objects.create(sender=self.me, receiver=self.friend, item=friend_item)
+        self.received_swap = SwapRequest.objects.create(sender=self.friend, receiver=self.me, item=self.my_item)
+        self.client.force_login(self.me)
+
+    def test_friend_requests_context(self):
+        context = self.client.get(reverse('friend_requests')).context
+        self.assertEqual(list(context['incoming']), [self.incoming_request])
+        self.assertEqual(list(context['outgoing']), [])
+        self.assertEqual([fr.from_user for fr in context['accepted']], [self.friend])
+
+    def test_request_list_context(self):
+        context = self.client.get(reverse('request_list')).context
+        self.assertEqual(list(context['incoming'].object_list), [self.received_swap])
+        self.assertEqual(list(context['outgoing'].object_list), [self.sent_swap])
+
+    def test_profile_context(self):
+        context = self.client.get(reverse('profile')).context
+        self.assertEqual(context['profile_user'], self.me)
+        self.assertEqual(list(context['items']), [self.my_item])
+        self.assertEqual(context['profile'].get_items_count(), 2)
+        self.assertEqual(context['profile'].get_friends_count(), 1)
+
+    def test_login_required_and_unknown_profile(self):
+        self.assertEqual(self.client.get(reverse('friend_profile', args=['nobody'])).status_code, 404)
+        self.client.logout()
+        response = self.client.get(reverse('request_list'))
+        login_url = f"{reverse('login')}?next={reverse('request_list')}"
+        self.assertRedirects(response, login_url, fetch_redirect_response=False)
+
+
+class AsyncViewTests(AsyncViewContextMixin, TestCase):
+    """Inside a transaction the queries run sequentially on the request's connection"""
+
+    def setUp(self):
+        self.create_fixtures()
+
+
+class ConcurrentAsyncViewTests(AsyncViewContextMixin, TransactionTestCase):
+    """Outside a transaction each query runs on its own worker connection"""
+
+    def setUp(self):
+        self.create_fixtures()
+
+
+class NotificationFoldingTests(TestCase):
+    def setUp(self):
+        self.recipient = User.objects.create_user('recipient')
+        self.actors = [User.objects.create_user(name) for name in ('alice', 'bob', 'carol')]
+
+    def test_unread_notifications_fold_per_target(self):
+        for actor in self.actors:
+            Notification.objects.notify(self.recipient, 'swap_request', actor, 'item:1', 'Blue Jacket')
+        Notification.objects.notify(self.recipient, 'swap_request', self.actors[0], 'item:2', 'Red Scarf')
+
+        folded = Notification.objects.get(user=self.recipient, target_key='item:1')
+        self.assertEqual(folded.actor_count, 3)
+        self.assertEqual(folded.text, "carol and 2 others requested Blue Jacket")
+        self.assertEqual(Notification.objects.filter(user=self.recipient).count(), 2)
+
+    def test_read_notifications_are_not_reused(self):
+        Notification.objects.notify(self.recipient, 'friend_request', self.actors[0])
+        Notification.objects.filter(user=self.recipient).update(read=True)
+        Notification.objects.notify(self.recipient, 'friend_request', self.actors[1])
+        latest = Notification.objects.get(user=self.recipient, read=False)
+        self.assertEqual(latest.actor_count, 1)
+        self.assertEqual(latest.text, "bob sent you a friend request")
+
+    def test_notify_many_folds_and_creates(self):
+        other = User.objects.create_user('other')
+        Notification.objects.notify(self.recipient, 'friend_request', self.actors[0])
+        Notification.objects.notify_many([self.recipient.pk, other.pk], 'friend_request', self.actors[1])
+        self.assertEqual(
+            Notification.objects.get(user=self.recipient).text, "bob and 1 other sent you friend requests"
+        )
+        self.assertEqual(Notification.objects.get(user=other).text, "bob sent you a friend request")
+
+    def test_ungroupable_type_is_rejected(self):
+        with self.assertRaises(ValueError):
+            Notification.objects.notify(self.recipient, 'digest', self.actors[0])
+
+
+    def test_digest_folds_unread_notifications_of_digest_users(self):
+        Profile.objects.create(user=self.recipient, digest_notifications=True)
+        for actor in self.actors[:2]:
+            Notification.objects.notify(self.recipient, 'friend_request', actor)
+        Notification.objects.notify(self.recipient, 'swap_request', self.actors[2], 'item:1', 'Blue Jacket')
+        Notification.objects.notify(self.actors[0], 'friend_request', self.actors[1])
+
+        call_command('send_notification_digests', stdout=StringIO())
+        digest = Notification.objects.get(user=self.recipient)
+        self.assertEqual(digest.notification_type, 'digest')
+        self.assertIn("×2", digest.text)
+        # Users without the digest option keep their notifications
+        self.assertEqual(Notification.objects.get(user=self.actors[0]).notification_type, 'friend_request')
+
+
+class ArchiveColdDataTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.sender = User.objects.create_user('sender')
+        self.long_ago = timezone.now() - timedelta(days=120)
+
+    def item(self, title, **fields):
+        item = Item.objects.create(owner=self.owner, title=title, is_available=False)
+        Item.objects.filter(pk=item.pk).update(updated_at=self.long_ago, **fields)
+        return item
+
+    def swap(self, item, status):
+        swap = SwapRequest.objects.create(sender=self.sender, receiver=self.owner, item=item, status=status)
+        SwapRequest.objects.filter(pk=swap.pk).update(updated_at=self.long_ago)
+        return swap
+
+    def archive(self, days=90):
+        call_command('archive_cold_data', days=days, stdout=StringIO())
+
+    def test_cold_items_move_with_their_finished_swaps(self):
+        item = self.item("Old coat")
+        swap = self.swap(item, 'completed')
+        self.archive()
+        self.assertFalse(Item.objects.filter(pk=item.pk).exists())
+        self.assertFalse(SwapRequest.objects.filter(pk=swap.pk).exists())
+        archived = ArchivedItem.objects.get(original_id=item.pk)
+        self.assertEqual(archived.title, "Old coat")
+        self.assertEqual(ArchivedSwapRequest.objects.get(original_id=swap.pk).original_item_id, item.pk)
+
+    def test_items_with_open_swaps_stay_hot(self):
+        item = self.item("Still wanted")
+        pending = self.swap(item, 'pending')
+        finished = self.swap(item, 'cancelled')
+        self.archive()
+        self.assertTrue(Item.objects.filter(pk=item.pk).exists())
+        self.assertTrue(SwapRequest.objects.filter(pk=pending.pk).exists())
+        # Finished swaps are archived on their own age, even when the item stays
+        self.assertTrue(ArchivedSwapRequest.objects.filter(original_id=finished.pk).exists())
+
+    def test_recent_and_available_items_stay_hot(self):
+        available = self.item("Available", is_available=True)
+        recent = Item.objects.create(owner=self.owner, title="Recent", is_available=False)
+        self.archive()
+        self.assertEqual(set(Item.objects.values_list('pk', flat=True)), {available.pk, recent.pk})
+        self.assertFalse(ArchivedItem.objects.exists())
+
+    def test_history_view_lists_archived_rows(self):
+        self.swap(self.item("Old coat"), 'completed')
+        self.archive()
+        self.client.force_login(self.owner)
+        response = self.client.get(reverse('item_history'))
+        self.assertEqual([item.title for item in response.context['page_obj']], ["Old coat"])
+        self.assertEqual([swap.item_title for swap in response.context['swap_page']], ["Old coat"])
+
+
+class SimilarItemIndexTests(SimpleTestCase):
+    def upsert(self, index, item_id, title, owner_id=1, category='tops', size='m'):
+        index.upsert(item_id, owner_id, title, '', category, size, True)
+
+    def query(self, index, title, owner_ids=(1,), limit=6):
+        probe = Item(id=0, title=title, description='', category='tops', size='m')
+        return index.query(probe, list(owner_ids), limit)
+
+    def test_removed_rows_are_reused(self):
+        index = SimilarItemIndex(dimensions=64, capacity=4)
+        for item_id in (1, 2, 3):
+            self.upsert(index, item_id, f"item {item_id}")
+        index.remove(2)
+        self.upsert(index, 4, "item four")
+        self.assertEqual(index._size, 3)
+        self.assertEqual(len(index), 3)
+        self.assertCountEqual(self.query(index, "item"), [1, 3, 4])
+
+    def test_grows_past_capacity_keeping_rows(self):
+        index = SimilarItemIndex(dimensions=64, capacity=2)
+        for item_id in range(1, 6):
+            self.upsert(index, item_id, f"jacket {item_id}")
+        self.assertGreaterEqual(len(index._ids), 5)
+        self.assertEqual(index._tf.shape[0], len(index._ids))
+        self.assertCountEqual(self.query(index, "jacket"), [1, 2, 3, 4, 5])
+
+    def test_document_frequencies_follow_updates(self):
+        index = SimilarItemIndex(dimensions=64)
+        self.upsert(index, 1, "wool scarf")
+        self.upsert(index, 1, "denim jeans")
+        self.upsert(index, 2, "denim jacket")
+        index.remove(2)
+        expected = (index.vectorize("denim jeans", "") > 0).astype(float)
+        self.assertEqual(index._df.tolist(), expected.tolist())
+
+    def test_unavailable_items_are_dropped(self):
+        index = SimilarItemIndex(dimensions=64)
+        self.upsert(index, 1, "blue jacket")
+        index.upsert(1, 1, "blue jacket", '', 'tops', 'm', False)
+        self.assertEqual(self.query(index, "blue jacket"), [])
+
+    def test_query_ranks_by_text_and_filters_owners(self):
+        index = SimilarItemIndex(dimensions=256)
+        self.upsert(index, 1, "red wool scarf")
+        self.upsert(index, 2, "blue denim jeans")
+        self.upsert(index, 3, "red wool scarf", owner_id=2)
+        self.assertEqual(self.query(index, "red wool scarf", limit=2), [1, 2])
+        self.assertEqual(self.query(index, "red wool scarf", owner_ids=(2,)), [3])
+
+
+class SimilarItemsTests(TestCase):
+    def setUp(self):
+        similarity._index = None
+        self.addCleanup(setattr, similarity, '_index', None)
+        self.viewer = User.objects.create_user('viewer')
+        self.friend = User.objects.create_user('friend')
+        FriendRequest.objects.create(from_user=self.viewer, to_user=self.friend, accepted=True)
+
+    def test_items_deleted_elsewhere_are_unindexed(self):
+        items = [Item.objects.create(owner=self.friend, title=f"wool jacket {i}") for i in range(5)]
+        probe = Item.objects.create(owner=self.viewer, title="wool jacket")
+        similarity._index = similarity._build_index()
+        self.assertEqual(len(similarity.similar_items(probe, self.viewer, limit=3)), 3)
+
+        # Another worker's delete: no signal reaches this process's index
+        Item.objects.filter(pk__in=[item.pk for item in items[:3]])._raw_delete('default')
+        found = similarity.similar_items(probe, self.viewer, limit=3)
+        self.assertCountEqual([item.pk for item in found], [items[3].pk, items[4].pk])
+        self.assertNotIn(items[0].pk, similarity._index._rows)
+
+    def test_local_saves_update_a_built_index(self):
+        similarity._index = similarity._build_index()
+        item = Item.objects.create(owner=self.friend, title="linen shirt")
+        self.assertIn(item.pk, similarity._index._rows)
+        item.delete()
+        self.assertNotIn(item.pk, similarity._index._rows)
+
+    def test_users_without_friends_never_build_the_index(self):
+        loner = User.objects.create_user('loner')
+        probe = Item.objects.create(owner=loner, title="wool jacket")
+        with mock.patch.object(similarity, 'get_index') as get_index:
+            self.assertEqual(similarity.similar_items(probe, loner), [])
+        get_index.assert_not_called()
+
+    def test_saving_items_does_not_load_the_module(self):
+        with mock.patch.dict(sys.modules):
+            del sys.modules['innercircle.similarity']
+            item = Item.objects.create(owner=self.friend, title="linen shirt")
+            item.delete()
+            self.assertNotIn('innercircle.similarity', sys.modules)
+
+
+class SimilarItemsBackgroundBuildTests(TransactionTestCase):
+    def setUp(self):
+        similarity._index = None
+        self.addCleanup(setattr, similarity, '_index', None)
+
+    def test_first_lookup_builds_in_the_background(self):
+        viewer = User.objects.create_user('viewer')
+        friend = User.objects.create_user('friend')
+        FriendRequest.objects.create(from_user=viewer, to_user=friend, accepted=True)
+        match = Item.objects.create(owner=friend, title="wool jacket")
+        probe = Item.objects.create(owner=viewer, title="wool jacket")
+
+        self.assertEqual(similarity.similar_items(probe, viewer), [])
+        for _ in range(200):
+            if similarity._index is not None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(similarity.similar_items(probe, viewer), [match])
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.force_login(self.admin)
+        self.owner = User.objects.create_user('owner', email='Owner@Example.com')
+        Profile.objects.create(user=self.owner)
+
+    def run_action(self, model, action, objects):
+        url = reverse(f'admin:innercircle_{model}_changelist')
+        return self.client.post(url, {
+            'action': action,
+            admin.helpers.ACTION_CHECKBOX_NAME: [obj.pk for obj in objects],
+        })
+
+    def test_mark_unavailable(self):
+        items = [Item.objects.create(owner=self.owner, title=f"item {i}") for i in range(3)]
+        self.run_action('item', 'mark_unavailable', items[:2])
+        self.assertEqual(list(Item.objects.filter(is_available=True)), [items[2]])
+
+    def test_cancel_stale_swaps_only_touches_old_pending_swaps(self):
+        item = Item.objects.create(owner=self.owner, title="item")
+        swaps = [SwapRequest.objects.create(sender=self.admin, receiver=self.owner, item=item) for _ in range(3)]
+        stale = timezone.now() - timedelta(days=STALE_SWAP_DAYS + 1)
+        SwapRequest.objects.filter(pk__in=[swaps[0].pk, swaps[1].pk]).update(created_at=stale)
+        SwapRequest.objects.filter(pk=swaps[1].pk).update(status='accepted')
+        self.run_action('swaprequest', 'cancel_stale_swaps', swaps)
+        statuses = dict(SwapRequest.objects.values_list('pk', 'status'))
+        self.assertEqual(
+            [statuses[swap.pk] for swap in swaps], ['cancelled', 'accepted', 'pending']
+        )
+
+    def test_purge_read_keeps_unread(self):
+        read = Notification.objects.create(user=self.owner, text="old", read=True)
+        unread = Notification.objects.create(user=self.owner, text="new")
+        self.run_action('notification', 'purge_read', [read, unread])
+        self.assertEqual(list(Notification.objects.all()), [unread])
+
+    def test_profile_changelist_queries_do_not_grow_with_rows(self):
+        url = reverse('admin:innercircle_profile_changelist')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for i in range(5):
+            Profile.objects.create(user=User.objects.create_user(f'user{i}'))
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertEqual(len(many), len(few))
+        self.assertContains(response, 'user4')
+
+    def test_profile_search_by_email_uses_the_hash(self):
+        Profile.objects.create(user=User.objects.create_user('other', email='other@example.com'))
+        url = reverse('admin:innercircle_profile_changelist')
+        response = self.client.get(url, {'q': ' owner@example.com '})
+        self.assertEqual([profile.user for profile in response.context['cl'].result_list], [self.owner])
+
+
+class EstimatedCountPaginatorTests(TestCase):
+    def setUp(self):
+        owner = User.objects.create_user('owner')
+        for i in range(3):
+            Item.objects.create(owner=owner, title=f"item {i}", is_available=i > 0)
+
+    def count(self, queryset, estimate, vendor='postgresql'):
+        cursor = mock.MagicMock()
+        cursor.fetchone.return_value = (estimate,)
+        fake = mock.MagicMock(vendor=vendor)
+        fake.cursor.return_value.__enter__.return_value = cursor
+        with mock.patch('innercircle.admin.connections', {'default': fake}):
+            return EstimatedCountPaginator(queryset.order_by('pk'), 100).count
+
+    def test_large_unfiltered_tables_use_the_estimate(self):
+        self.assertEqual(self.count(Item.objects.all(), 2000000), 2000000)
+
+    def test_small_filtered_or_non_postgres_tables_count_exactly(self):
+        self.assertEqual(self.count(Item.objects.all(), 500), 3)
+        self.assertEqual(self.count(Item.objects.filter(is_available=True), 2000000), 2)
+        self.assertEqual(self.count(Item.objects.all(), 2000000, vendor='sqlite'), 3)
+
+
+class SwapStateTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user('owner')
+        self.viewer = User.objects.create_user('viewer')
+        self.other = User.objects.create_user('other')
+        FriendRequest.objects.create(from_user=self.viewer, to_user=self.owner, accepted=True)
+        self.item = Item.objects.create(owner=self.owner, title="Blue Jacket")
+        self.untouched = Item.objects.create(owner=self.owner, title="Red Scarf")
+
+    def swap(self, sender, status='pending'):
+        return SwapRequest.objects.create(sender=sender, receiver=self.owner, item=self.item, status=status)
+
+    def state(self, item, user):
+        annotated = Item.objects.with_swap_state(user).get(pk=item.pk)
+        return annotated.pending_request_count, annotated.requested_by_me
+
+    def test_counts_pending_requests_and_the_viewers_active_one(self):
+        self.swap(self.viewer, 'cancelled')
+        self.assertEqual(self.state(self.item, self.viewer), (0, False))
+        self.swap(self.other)
+        self.assertEqual(self.state(self.item, self.viewer), (1, False))
+        self.swap(self.viewer, 'accepted')
+        self.assertEqual(self.state(self.item, self.viewer), (1, True))
+        self.assertEqual(self.state(self.item, self.other), (1, True))
+        self.assertEqual(self.state(self.untouched, self.viewer), (0, False))
+
+    def test_feed_hides_the_request_button_once_requested(self):
+        self.swap(self.viewer)
+        self.client.force_login(self.viewer)
+        response = self.client.get(reverse('item_list'))
+        self.assertNotContains(response, reverse('request_create', args=[self.item.pk]))
+        self.assertContains(response, reverse('request_create', args=[self.untouched.pk]))
+        self.assertContains(response, "Requested")
+
+    def test_duplicate_requests_are_refused(self):
+        self.swap(self.viewer)
+        self.client.force_login(self.viewer)
+        self.client.post(reverse('request_create', args=[self.item.pk]), {'message': "again"})
+        self.assertEqual(SwapRequest.objects.filter(sender=self.viewer).count(), 1)
+
+
+class RateLimitTests(SimpleTestCase):
+    def consume_at(self, backend, moment, key='k', capacity=3, period=60):
+        with mock.patch('innercircle.ratelimit.time.monotonic', return_value=moment):
+            return backend.consume(key, capacity, period)
+
+    def test_parse_rate(self):
+        self.assertEqual(parse_rate('30/h'), (30, 3600))
+
+    def test_bucket_empties_then_refills_evenly(self):
+        backend = LocalMemoryBackend()
+        self.assertEqual([self.consume_at(backend, 100.0) for _ in range(3)], [0, 0, 0])
+        # Empty: one token comes back every period / capacity = 20 seconds
+        self.assertAlmostEqual(self.consume_at(backend, 100.0), 20.0)
+        self.assertAlmostEqual(self.consume_at(backend, 110.0), 10.0)
+        self.assertEqual(self.consume_at(backend, 120.0), 0)
+        self.assertGreater(self.consume_at(backend, 120.0), 0)
+
+    def test_refill_is_capped_at_capacity(self):
+        backend = LocalMemoryBackend()
+        self.consume_at(backend, 0.0)
+        allowed = [self.consume_at(backend, 10000.0) for _ in range(4)]
+        self.assertEqual(allowed[:3], [0, 0, 0])
+        self.assertGreater(allowed[3], 0)
+
+    def test_keys_have_separate_buckets(self):
+        backend = LocalMemoryBackend()
+        for _ in range(3):
+            self.consume_at(backend, 0.0, key='a')
+        self.assertGreater(self.consume_at(backend, 0.0, key='a'), 0)
+        self.assertEqual(self.consume_at(backend, 0.0, key='b'), 0)
+
+    def test_least_recently_used_buckets_are_evicted_in_bulk(self):
+        backend = LocalMemoryBackend()
+        backend.max_entries = 10
+        for i in range(10):
+            self.consume_at(backend, 0.0, key=f'k{i}')
+        self.consume_at(backend, 0.0, key='k0')  # now the most recently used
+        self.consume_at(backend, 0.0, key='new')
+        self.assertEqual(list(backend._buckets), ['k3', 'k4', 'k5', 'k6', 'k7', 'k8', 'k9', 'k0', 'new'])
+        # Below the limit again: the next hits don't scan or evict
+        self.consume_at(backend, 0.0, key='another')
+        self.assertEqual(len(backend._buckets), 10)
+
+
+class RateLimitCheckTests(SimpleTestCase):
+    def setUp(self):
+        ratelimit._backend = LocalMemoryBackend()
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+        self.factory = RequestFactory()
+
+    def request(self, session=None, user=None):
+        request = self.factory.post('/requests/create/1/')
+        if session:
+            request.COOKIES[settings.SESSION_COOKIE_NAME] = session
+        request.user = SimpleLazyObject(user or self.fail_resolving_user)
+        return request
+
+    def fail_resolving_user(self):
+        self.fail("request.user was resolved")
+
+    def user(self, pk):
+        return lambda: mock.Mock(pk=pk, is_authenticated=True)
+
+    def test_over_limit_session_is_rejected_before_resolving_the_user(self):
+        self.assertIsNone(ratelimit.check(self.request('abc', self.user(1)), 'g', '1/m'))
+        response = ratelimit.check(self.request('abc'), 'g', '1/m')
+        self.assertEqual(response.status_code, 429)
+        self.assertIn(response['Retry-After'], ('60', '61'))
+
+    def test_requests_without_a_session_are_keyed_on_ip(self):
+        self.assertIsNone(ratelimit.check(self.request(), 'g', '1/m'))
+        self.assertEqual(ratelimit.check(self.request(), 'g', '1/m').status_code, 429)
+
+    def test_user_limit_applies_across_sessions(self):
+        self.assertIsNone(ratelimit.check(self.request('first', self.user(1)), 'g', '1/m'))
+        self.assertEqual(ratelimit.check(self.request('second', self.user(1)), 'g', '1/m').status_code, 429)
+        self.assertIsNone(ratelimit.check(self.request('third', self.user(2)), 'g', '1/m'))
+
+    async def test_async_check_matches(self):
+        self.assertIsNone(await ratelimit.acheck(self.request('abc', self.user(1)), 'g', '1/m'))
+        response = await ratelimit.acheck(self.request('abc'), 'g', '1/m')
+        self.assertEqual(response.status_code, 429)
+
+    def test_middleware_stays_async_under_asgi(self):
+        handler = ASGIHandler()
+        handler.load_middleware(is_async=True)
+        limiter = [m for m in handler._view_middleware if getattr(m, '__self__', None).__class__ is RateLimitMiddleware]
+        self.assertEqual(len(limiter), 1)
+        self.assertTrue(iscoroutinefunction(limiter[0]))
+
+
+@override_settings(RATELIMITS={'login': {'rate': '2/m', 'key': 'ip', 'methods': ['POST']}})
+class RateLimitMiddlewareTests(TestCase):
+    def setUp(self):
+        ratelimit._backend = LocalMemoryBackend()
+        self.addCleanup(setattr, ratelimit, '_backend', None)
+
+    def test_login_posts_are_limited_per_ip(self):
+        url = reverse('login')
+        statuses = [self.client.post(url, {'username': 'x', 'password': 'y'}).status_code for _ in range(3)]
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class MediaBlobTests(TestCase):
+    def save_photo(self, item, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            item.photo.save('photo.png', ContentFile(content))
+
+    def test_identical_uploads_share_one_counted_blob(self):
+        owner = User.objects.create_user('owner')
+        first = Item.objects.create(owner=owner, title="one")
+        second = Item.objects.create(owner=owner, title="two")
+        self.save_photo(first, b'same bytes')
+        self.save_photo(second, b'same bytes')
+        self.assertEqual(first.photo.name, second.photo.name)
+        self.assertTrue(blob_storage.is_blob(first.photo.name))
+        self.assertEqual(MediaBlob.objects.get(name=first.photo.name).ref_count, 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(MediaBlob.objects.get(name=second.photo.name).ref_count, 1)
+        self.assertTrue(blob_storage.exists(second.photo.name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(MediaBlob.objects.filter(name=second.photo.name).exists())
+        self.assertFalse(blob_storage.exists(second.photo.name))
+
+    def test_replacing_a_photo_moves_the_reference(self):
+        item = Item.objects.create(owner=User.objects.create_user('owner'), title="item")
+        self.save_photo(item, b'old')
+        old = item.photo.name
+        self.save_photo(item, b'new')
+        self.assertFalse(MediaBlob.objects.filter(name=old).exists())
+        self.assertEqual(MediaBlob.objects.get(name=item.photo.name).ref_count, 1)
+
+    def test_blob_retained_again_before_commit_is_kept(self):
+        item = Item.objects.create(owner=User.objects.create_user('owner'), title="item")
+        self.save_photo(item, b'bytes')
+        name = item.photo.name
+        with self.captureOnCommitCallbacks(execute=True):
+            item.delete()
+            # A concurrent upload of the same content found the file and retained it
+            MediaBlob.objects.retain([name])
+        self.assertTrue(blob_storage.exists(name))
+        self.assertEqual(MediaBlob.objects.get(name=name).ref_count, 1)
+
+    def test_upload_is_retained_before_its_row_is_saved(self):
+        owner = User.objects.create_user('owner')
+        item = Item.objects.create(owner=owner, title="item")
+        self.save_photo(item, b'bytes')
+        name = item.photo.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            item.delete()
+        # The same content is uploaded again, finding the file still in place,
+        # and the release's delete runs before the new row is saved
+        stored = blob_storage.save('photo.png', ContentFile(b'bytes'))
+        for callback in callbacks:
+            callback()
+        self.assertEqual(stored, name)
+        self.assertTrue(blob_storage.exists(name))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Item.objects.create(owner=owner, title="again", photo=stored)
+        self.assertEqual(MediaBlob.objects.get(name=name).ref_count, 1)
+
+    def test_rebuild_counts_from_rows(self):
+        owner = User.objects.create_user('owner')
+        item = Item.objects.create(owner=owner, title="item")
+        self.save_photo(item, b'bytes')
+        Item.objects.create(owner=owner, title="copy", photo=item.photo.name)
+        MediaBlob.objects.update(ref_count=7)
+        MediaBlob.objects.create(name='blobs/00/00/stale.png', ref_count=1)
+
+        dedupe_media.Command()._rebuild_counts()
+        self.assertEqual(dict(MediaBlob.objects.values_list('name', 'ref_count')), {item.photo.name: 2})
+
+
+class FriendContactsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('me')
+        self.contact = User.objects.create_user('contact', email='Contact@Example.com')
+        self.stranger = User.objects.create_user('stranger', email='stranger@example.com')
+        for user in (self.user, self.contact, self.stranger):
+            Profile.objects.create(user=user)
+        self.client.force_login(self.user)
+        self.url = reverse('friend_contacts')
+
+    def test_requests_only_go_to_matched_users(self):
+        response = self.client.post(self.url, {'emails': 'contact@example.com'})
+        self.assertEqual([match.pk for match in response.context['matches']], [self.contact.pk])
+
+        self.client.post(self.url, {'action': 'send', 'user_ids': [self.contact.pk, self.stranger.pk]})
+        self.assertEqual(
+            list(FriendRequest.objects.values_list('to_user', flat=True)), [self.contact.pk]
+        )
+        self.assertEqual(Notification.objects.filter(user=self.stranger).count(), 0)
+
+    def test_send_without_matching_is_rejected(self):
+        response = self.client.post(self.url, {'action': 'send', 'user_ids': [self.stranger.pk]})
+        self.assertRedirects(response, self.url)
+        self.assertFalse(FriendRequest.objects.exists())
+
+    def test_backfill_email_hashes(self):
+        Profile.objects.update(email_hash='')
+        call_command('backfill_email_hashes', stdout=StringIO())
+        response = self.client.post(self.url, {'emails': 'contact@example.com'})
+        self.assertEqual([match.pk for match in response.context['matches']], [self.contact.pk])
+
+
+class ContactMatchFormTests(SimpleTestCase):
+    def clean(self, emails='', upload=None):
+        form = ContactMatchForm({'emails': emails}, {'contacts_file': upload} if upload else {})
+        return form.cleaned_data.get('addresses') if form.is_valid() else form.non_field_errors()
+
+    def test_addresses_from_text_and_upload_are_merged(self):
+        vcard = SimpleUploadedFile('contacts.vcf', 'EMAIL:Ana@Example.com\nNOTE:café\nEMAIL:bo@example.org\n'.encode())
+        with mock.patch.object(vcard, 'chunks', side_effect=lambda: iter([vcard.read(10), vcard.read()])):
+            addresses = self.clean('bo@example.org, cy@example.net', vcard)
+        self.assertEqual(addresses, ['bo@example.org', 'cy@example.net', 'ana@example.com'])
+
+    def test_oversized_upload_is_rejected_unread(self):
+        upload = SimpleUploadedFile('contacts.csv', b'x' * (ContactMatchForm.MAX_UPLOAD_SIZE + 1))
+        with mock.patch.object(upload, 'chunks') as chunks:
+            errors = self.clean(upload=upload)
+        chunks.assert_not_called()
+        self.assertIn("at most 2 MB", errors[0])
+
+    def test_reading_stops_past_the_limit(self):
+        with mock.patch.object(ContactMatchForm, 'MAX_CONTACTS', 3):
+            lines = iter(f'user{i}@example.com' for i in range(10))
+            self.assertEqual(len(ContactMatchForm()._find_addresses(lines)), 4)
+            self.assertEqual(next(lines), 'user4@example.com')
+            errors = self.clean('\n'.join(f'user{i}@example.com' for i in range(10)))
+        self.assertEqual(errors, ["Please upload at most 3 addresses at a time."])
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.sender = User.objects.create_user('sender')
+        self.receiver = User.objects.create_user('receiver')
+        self.now = timezone.now()
+
+    def complete_swap(self, category='tops', at=None):
+        at = at or self.now - timedelta(hours=1)
+        item = Item.objects.create(owner=self.receiver, title="item", category=category, is_available=False)
+        swap = SwapRequest.objects.create(sender=self.sender, receiver=self.receiver, item=item)
+        SwapRequest.objects.filter(pk=swap.pk).update(
+            status='completed',
+            created_at=at - timedelta(minutes=30),
+            accepted_at=at,
+            completed_at=at,
+            updated_at=self.now - timedelta(days=1),
+        )
+        Item.objects.filter(pk=item.pk).update(updated_at=self.now - timedelta(days=1))
+
+    def completed(self):
+        return dict(MetricRollup.objects.filter(metric='swaps_completed').values_list('dimension', 'value'))
+
+    def test_each_swap_is_counted_once(self):
+        self.complete_swap('tops')
+        self.assertEqual(analytics.update_rollups(until=self.now), 2)
+        self.assertEqual(analytics.update_rollups(until=self.now), 0)
+
+        self.complete_swap('bottoms', at=self.now + timedelta(minutes=1))
+        self.assertEqual(analytics.update_rollups(until=self.now + timedelta(minutes=2)), 2)
+        self.assertEqual(self.completed(), {'tops': 1, 'bottoms': 1})
+
+    def test_swaps_after_the_window_wait_for_the_next_run(self):
+        self.complete_swap(at=self.now)
+        self.assertEqual(analytics.update_rollups(until=self.now - timedelta(minutes=1)), 0)
+        self.assertEqual(analytics.update_rollups(until=self.now), 2)
+
+    def test_default_window_lags_behind_now(self):
+        self.complete_swap(at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(analytics.update_rollups(), 0)
+        checkpoint = AnalyticsCheckpoint.objects.get(name=analytics.CHECKPOINT)
+        self.assertLessEqual(checkpoint.position, timezone.now() - analytics.SAFETY_LAG)
+        self.assertEqual(analytics.update_rollups(until=timezone.now()), 2)
+
+    def test_rebuild_includes_archived_swaps(self):
+        self.complete_swap('tops')
+        analytics.update_rollups(until=self.now)
+        call_command('archive_cold_data', days=0, stdout=StringIO())
+        self.assertFalse(SwapRequest.objects.exists())
+
+        analytics.reset_rollups()
+        self.assertEqual(analytics.update_rollups(until=self.now), 2)
+        self.assertEqual(self.completed(), {'tops': 1})
+
+    def test_archiving_takes_the_rollup_lock_before_moving_swaps(self):
+        self.complete_swap('tops')
+        moved = []
+
+        def lock():
+            moved.append(ArchivedSwapRequest.objects.count())
+            return analytics.lock_checkpoint()
+
+        with mock.patch('innercircle.management.commands.archive_cold_data.lock_checkpoint', side_effect=lock):
+            call_command('archive_cold_data', days=0, stdout=StringIO())
+        self.assertEqual(moved[0], 0)
+        self.assertEqual(ArchivedSwapRequest.objects.count(), 1)
+
+    def test_median_from_histogram(self):
+        histogram = {analytics.latency_bucket(60 * minutes): 1 for minutes in (1, 10, 100)}
+        median = analytics.median_from_histogram(histogram)
+        self.assertAlmostEqual(median, 10, delta=10 * 0.2)
+
+
+class RankFeedTests(TestCase):
+    def setUp(self):
+        self.viewer = User.objects.create_user('viewer')
+        self.close = User.objects.create_user('close')
+        self.distant = User.objects.create_user('distant')
+        for friend in (self.close, self.distant):
+            FriendRequest.objects.create(from_user=self.viewer, to_user=friend, accepted=True)
+
+    def item(self, owner, category='other', size='', hours_old=1):
+        item = Item.objects.create(owner=owner, title="item", category=category, size=size)
+        Item.objects.filter(pk=item.pk).update(created_at=timezone.now() - timedelta(hours=hours_old))
+        return item
+
+    def preferences(self, codes, choice):
+        vector = [0.0] * (len(codes) + 1)
+        if choice:
+            vector[codes[choice]] = 1.0
+        return vector
+
+    def affinity(self, owners=None, category=None, size=None):
+        return {
+            'owners': owners or {},
+            'categories': self.preferences(CATEGORY_CODES, category),
+            'sizes': self.preferences(SIZE_CODES, size),
+            'built_at': time.time(),
+        }
+
+    def rank(self, affinity):
+        with mock.patch('innercircle.ranking.get_affinity', return_value=affinity):
+            return ranking.rank_feed(self.viewer, Item.objects.all())
+
+    def test_recency_orders_items_without_affinity(self):
+        old, new = self.item(self.distant, hours_old=50), self.item(self.distant, hours_old=2)
+        self.assertEqual(self.rank(self.affinity()), [new.pk, old.pk])
+
+    def test_owner_affinity_outweighs_a_little_recency(self):
+        distant = self.item(self.distant, hours_old=2)
+        close = self.item(self.close, hours_old=10)
+        self.assertEqual(self.rank(self.affinity(owners={self.close.pk: 1.0})), [close.pk, distant.pk])
+
+    def test_category_and_size_matches_break_ties(self):
+        plain = self.item(self.distant)
+        sized = self.item(self.distant, size='m')
+        matching = self.item(self.distant, category='dresses')
+        ranked = self.rank(self.affinity(category='dresses', size='m'))
+        self.assertEqual(ranked, [matching.pk, sized.pk, plain.pk])
+
+    def test_only_the_newest_window_is_ranked(self):
+        old = self.item(self.close, hours_old=100)
+        self.item(self.distant)
+        with mock.patch.object(ranking, 'CANDIDATE_WINDOW', 1):
+            self.assertNotIn(old.pk, self.rank(self.affinity(owners={self.close.pk: 1.0})))
+
+    def test_empty_feed_skips_the_affinity(self):
+        with mock.patch('innercircle.ranking.get_affinity') as get_affinity:
+            self.assertEqual(ranking.rank_feed(self.viewer, Item.objects.none()), [])
+        get_affinity.assert_not_called()
+
+    def test_ranked_feed_view(self):
+        distant = self.item(self.distant, hours_old=2)
+        close = self.item(self.close, hours_old=10)
+        self.client.force_login(self.viewer)
+        with mock.patch('innercircle.ranking.get_affinity', return_value=self.affinity(owners={self.close.pk: 1.0})):
+            response = self.client.get(reverse('item_list'), {'sort': 'ranked'})
+        self.assertEqual([item.pk for item in response.context['page_obj']], [close.pk, distant.pk])
+
+
+class BuildAffinityTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.viewer = User.objects.create_user('viewer')
+        self.partner = User.objects.create_user('partner')
+        self.mutual = User.objects.create_user('mutual')
+        self.stranger = User.objects.create_user('stranger')
+        for friend in (self.partner, self.mutual):
+            FriendRequest.objects.create(from_user=self.viewer, to_user=friend, accepted=True)
+        FriendRequest.objects.create(from_user=self.partner, to_user=self.mutual, accepted=True)
+
+    def test_owners_categories_and_sizes(self):
+        Item.objects.create(owner=self.viewer, title="own", category='tops', size='s')
+        theirs = Item.objects.create(owner=self.partner, title="theirs", category='tops', size='m')
+        SwapRequest.objects.create(sender=self.viewer, receiver=self.partner, item=theirs)
+        stranger_item = Item.objects.create(owner=self.stranger, title="other", category='shoes')
+        SwapRequest.objects.create(sender=self.viewer, receiver=self.stranger, item=stranger_item)
+
+        affinity = ranking.build_affinity(self.viewer)
+        # Only friends get owner affinity; the swap partner ranks above the mutual friend
+        self.assertEqual(set(affinity['owners']), {self.partner.pk, self.mutual.pk})
+        self.assertEqual(affinity['owners'][self.partner.pk], 1.0)
+        self.assertLess(affinity['owners'][self.mutual.pk], 1.0)
+        self.assertEqual(affinity['categories'][CATEGORY_CODES['tops']], 1.0)
+        self.assertEqual(affinity['categories'][CATEGORY_CODES['shoes']], 0.5)
+        self.assertEqual(affinity['sizes'][SIZE_CODES['s']], 1.0)
+        self.assertEqual(affinity['sizes'][SIZE_CODES['m']], 1.0)
+
+    def test_stale_affinity_is_served_while_refreshing(self):
+        stale = {**ranking.build_affinity(self.viewer), 'built_at': time.time() - ranking.AFFINITY_REFRESH - 1}
+        cache.set(ranking._cache_key(self.viewer.pk), stale)
+        with mock.patch('innercircle.ranking.threading.Thread') as thread:
+            self.assertEqual(ranking.get_affinity(self.viewer)['built_at'], stale['built_at'])
+            ranking.get_affinity(self.viewer)
+        thread.assert_called_once()
+
+    def test_refresh_closes_its_connections(self):
+        with mock.patch('innercircle.ranking.build_affinity', side_effect=RuntimeError), \
+                mock.patch('innercircle.ranking.connections') as connections, \
+                self.assertLogs('innercircle.ranking', 'ERROR'):
+            ranking._refresh(self.viewer)
+        connections.close_all.assert_called_once()
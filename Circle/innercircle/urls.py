@@ -14,9 +14,11 @@ urlpatterns = [
     path('items/<int:item_id>/edit/', views.item_update_view, name='item_update'),
     path('items/<int:item_id>/delete/', views.item_delete_view, name='item_delete'),
     path('my-items/', views.my_items_view, name='my_items'),
+    path('my-items/history/', views.item_history_view, name='item_history'),
     
     # Friends
     path('friends/search/', views.friend_search_view, name='friend_search'),
+    path('friends/contacts/', views.friend_contacts_view, name='friend_contacts'),
     path('friends/request/<int:user_id>/', views.friend_request_create_view, name='friend_request_create'),
     path('friends/requests/', views.friend_requests_view, name='friend_requests'),
     path('friends/requests/<int:request_id>/accept/', views.friend_request_accept_view, name='friend_request_accept'),
@@ -36,5 +38,8 @@ urlpatterns = [
     # Notifications
     path('notifications/', views.notifications_view, name='notifications'),
     path('notifications/<int:notif_id>/read/', views.notification_read_view, name='notification_read'),
+    
+    # Staff
+    path('analytics/', views.analytics_view, name='analytics'),
 ]
 
@@ -1,19 +1,81 @@
+import asyncio
+import csv
+from functools import wraps
+
+from asgiref.sync import sync_to_async
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import authenticate, login, logout, get_user_model
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm, PasswordChangeForm
-from django.contrib.auth.views import PasswordChangeView
+from django.contrib.auth.views import PasswordChangeView, redirect_to_login
 from django.contrib import messages
+from django.db import close_old_connections, connection
 from django.db.models import Q
 from django.core.paginator import Paginator
-from django.http import Http404
+from django.http import Http404, JsonResponse, StreamingHttpResponse
 from django.views.generic import FormView
 
-from .forms import RegisterForm, ItemForm, ProfileForm, SwapRequestForm
-from .models import Item, FriendRequest, SwapRequest, Notification, Profile
+from . import analytics
+from .forms import RegisterForm, ItemForm, ProfileForm, SwapRequestForm, ContactMatchForm
+from .models import Item, FriendRequest, SwapRequest, Notification, Profile, ArchivedItem, ArchivedSwapRequest, hash_email
 
 User = get_user_model()
 
+CONTACT_MATCHES_SESSION_KEY = 'contact_matches'
+
+
+def async_login_required(view_func):
+    """login_required for coroutine views (resolves the lazy user off the event loop)"""
+    @wraps(view_func)
+    async def _wrapped(request, *args, **kwargs):
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view_func(request, *args, **kwargs)
+    return _wrapped
+
+
+def _run_isolated(func, *args):
+    """Run a blocking ORM call on a worker thread with its own DB connection"""
+    try:
+        return func(*args)
+    finally:
+        # Worker threads live outside the request cycle, so honour CONN_MAX_AGE here
+        close_old_connections()
+
+
+async def _gather(*calls):
+    """Run independent (func, *args) ORM calls concurrently, one connection each"""
+    if await sync_to_async(lambda: connection.in_atomic_block)():
+        # Other connections can't see this transaction's writes (e.g. in TestCase)
+        return [await sync_to_async(call[0])(*call[1:]) for call in calls]
+    return await asyncio.gather(*(
+        sync_to_async(_run_isolated, thread_sensitive=False)(*call) for call in calls
+    ))
+
+
+def _evaluate(queryset):
+    """Fill the queryset's result cache so templates never hit the DB again"""
+    len(queryset)
+    return queryset
+
+
+def _count(queryset):
+    return queryset.count()
+
+
+def _get_page(queryset, per_page, number):
+    """Paginate and materialise the page's rows"""
+    page = Paginator(queryset, per_page).get_page(number)
+    page.object_list = list(page.object_list)
+    return page
+
+
+async def _arender(request, template_name, context):
+    # Template rendering touches the session/messages, which are sync-only
+    return await sync_to_async(render)(request, template_name, context)
+
 
 def login_view(request):
     """User login with form validation"""
@@ -67,28 +129,27 @@ def register_view(request):
 @login_required
 def item_list_view(request):
     """Main feed showing items from friends"""
-    # Get friend IDs
-    friend_ids = FriendRequest.objects.filter(
-        Q(from_user=request.user, accepted=True) | Q(to_user=request.user, accepted=True)
-    ).values_list('from_user', 'to_user')
-    
-    friend_set = set()
-    for from_id, to_id in friend_ids:
-        friend_set.add(from_id)
-        friend_set.add(to_id)
-    friend_set.discard(request.user.id)
+    friend_set = FriendRequest.friend_ids(request.user)
     
     # Include own items + friends' items
-    items = Item.objects.filter(
+    feed = Item.objects.filter(
         Q(owner=request.user) | Q(owner_id__in=friend_set),
         is_available=True
-    ).select_related('owner').prefetch_related('swap_requests').order_by('-created_at')
-    
-    paginator = Paginator(items, 12)
+    )
+    items = feed.select_related('owner').with_swap_state(request.user).order_by('-created_at')
     page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    ranked = request.GET.get('sort') == 'ranked'
+    
+    if ranked:
+        # numpy-backed, so only loaded once someone asks for a ranked feed
+        from .ranking import rank_feed
+        page_obj = Paginator(rank_feed(request.user, feed), 12).get_page(page_number)
+        by_id = {item.pk: item for item in items.filter(pk__in=page_obj.object_list)}
+        page_obj.object_list = [by_id[pk] for pk in page_obj.object_list if pk in by_id]
+    else:
+        page_obj = Paginator(items, 12).get_page(page_number)
     
-    return render(request, 'innercircle/item_list.html', {'page_obj': page_obj})
+    return render(request, 'innercircle/item_list.html', {'page_obj': page_obj, 'ranked': ranked})
 
 
 @login_required
@@ -114,8 +175,12 @@ def item_create_view(request):
 @login_required
 def item_detail_view(request, item_id):
     """View single item details"""
-    item = get_object_or_404(Item, pk=item_id)
-    return render(request, 'innercircle/item_detail.html', {'item': item})
+    from .similarity import similar_items
+    item = get_object_or_404(Item.objects.select_related('owner').with_swap_state(request.user), pk=item_id)
+    return render(request, 'innercircle/item_detail.html', {
+        'item': item,
+        'similar_items': similar_items(item, request.user),
+    })
 
 
 @login_required
@@ -162,6 +227,18 @@ def my_items_view(request):
     return render(request, 'innercircle/my_items.html', {'page_obj': page_obj})
 
 
+@login_required
+def item_history_view(request):
+    """View archived items and swaps, kept out of the hot tables"""
+    items = ArchivedItem.objects.filter(owner=request.user)
+    swaps = ArchivedSwapRequest.objects.filter(
+        Q(sender=request.user) | Q(receiver=request.user)
+    ).select_related('sender', 'receiver')
+    page_obj = Paginator(items, 12).get_page(request.GET.get('page'))
+    swap_page = Paginator(swaps, 20).get_page(request.GET.get('page_swaps'))
+    return render(request, 'innercircle/item_history.html', {'page_obj': page_obj, 'swap_page': swap_page})
+
+
 @login_required
 def friend_search_view(request):
     """Search for users to send friend requests"""
@@ -174,16 +251,79 @@ def friend_search_view(request):
     return render(request, 'innercircle/friend_search.html', {'results': results, 'query': query})
 
 
+def _friendship_status(user, user_ids):
+    """Map user id -> 'friends', 'sent' or 'received' for existing requests"""
+    statuses = {}
+    pairs = FriendRequest.objects.filter(
+        Q(from_user=user, to_user__in=user_ids) | Q(to_user=user, from_user__in=user_ids)
+    ).values_list('from_user', 'to_user', 'accepted')
+    for from_id, to_id, accepted in pairs:
+        if from_id == user.id:
+            statuses[to_id] = 'friends' if accepted else 'sent'
+        else:
+            statuses[from_id] = 'friends' if accepted else 'received'
+    return statuses
+
+
 @login_required
-def friend_requests_view(request):
+def friend_contacts_view(request):
+    """Match a batch of contact emails against registered users"""
+    matches = []
+    if request.method == 'POST' and request.POST.get('action') == 'send':
+        # Only users matched from this user's own contacts can be sent requests in bulk
+        matched = set(request.session.pop(CONTACT_MATCHES_SESSION_KEY, []))
+        requested = request.POST.getlist('user_ids')
+        if not matched or len(requested) > ContactMatchForm.MAX_CONTACTS:
+            messages.error(request, "Please match your contacts again before sending requests.")
+            return redirect('friend_contacts')
+        selected = {int(pk) for pk in requested if pk.isdigit()} & matched
+        selected = set(
+            User.objects.filter(pk__in=selected).exclude(pk=request.user.pk).values_list('pk', flat=True)
+        )
+        recipients = [pk for pk in selected if pk not in _friendship_status(request.user, selected)]
+        FriendRequest.objects.bulk_create(
+            [FriendRequest(from_user=request.user, to_user_id=pk) for pk in recipients],
+            ignore_conflicts=True,
+        )
+        Notification.objects.notify_many(recipients, 'friend_request', actor=request.user)
+        messages.success(request, f"Sent {len(recipients)} friend request{'s' if len(recipients) != 1 else ''}.")
+        return redirect('friend_requests')
+
+    if request.method == 'POST':
+        form = ContactMatchForm(request.POST, request.FILES)
+        if form.is_valid():
+            hashes = [hash_email(address) for address in form.cleaned_data['addresses']]
+            profiles = Profile.objects.filter(email_hash__in=hashes).exclude(
+                user=request.user
+            ).select_related('user')
+            matches = [profile.user for profile in profiles]
+            request.session[CONTACT_MATCHES_SESSION_KEY] = [match.pk for match in matches]
+            statuses = _friendship_status(request.user, [match.pk for match in matches])
+            for match in matches:
+                match.friendship_status = statuses.get(match.pk)
+            if not matches:
+                messages.info(request, "None of those contacts are on InnerCircle yet.")
+        else:
+            for error in form.non_field_errors():
+                messages.error(request, error)
+    else:
+        form = ContactMatchForm()
+    return render(request, 'innercircle/friend_contacts.html', {'form': form, 'matches': matches})
+
+
+@async_login_required
+async def friend_requests_view(request):
     """View incoming and outgoing friend requests"""
-    incoming = FriendRequest.objects.filter(to_user=request.user, accepted=False)
-    outgoing = FriendRequest.objects.filter(from_user=request.user, accepted=False)
-    accepted = FriendRequest.objects.filter(
-        Q(from_user=request.user, accepted=True) | Q(to_user=request.user, accepted=True)
+    user = request.user
+    incoming, outgoing, accepted = await _gather(
+        (_evaluate, FriendRequest.objects.filter(to_user=user, accepted=False).select_related('from_user')),
+        (_evaluate, FriendRequest.objects.filter(from_user=user, accepted=False).select_related('to_user')),
+        (_evaluate, FriendRequest.objects.filter(
+            Q(from_user=user, accepted=True) | Q(to_user=user, accepted=True)
+        ).select_related('from_user', 'to_user')),
     )
     
-    return render(request, 'innercircle/friend_requests.html', {
+    return await _arender(request, 'innercircle/friend_requests.html', {
         'incoming': incoming,
         'outgoing': outgoing,
         'accepted': accepted
@@ -205,11 +345,7 @@ def friend_request_create_view(request, user_id):
         return redirect('friend_search')
     
     FriendRequest.objects.create(from_user=request.user, to_user=to_user)
-    Notification.objects.create(
-        user=to_user,
-        text=f"{request.user.username} sent you a friend request",
-        notification_type='friend_request'
-    )
+    Notification.objects.notify(to_user, 'friend_request', actor=request.user)
     messages.success(request, f"Friend request sent to {to_user.username}!")
     return redirect('friend_search')
 
@@ -259,6 +395,12 @@ def request_create_view(request, item_id):
         messages.error(request, "You must be friends to request items.")
         return redirect('item_detail', item_id=item.id)
     
+    if SwapRequest.objects.filter(
+        sender=request.user, item=item, status__in=SwapRequest.ACTIVE_STATUSES
+    ).exists():
+        messages.warning(request, "You already requested this item.")
+        return redirect('item_detail', item_id=item.id)
+    
     if request.method == 'POST':
         form = SwapRequestForm(request.POST)
         if form.is_valid():
@@ -268,10 +410,9 @@ def request_create_view(request, item_id):
                 item=item,
                 message=form.cleaned_data.get('message', '')
             )
-            Notification.objects.create(
-                user=item.owner,
-                text=f"{request.user.username} requested {item.title}",
-                notification_type='swap_request'
+            Notification.objects.notify(
+                item.owner, 'swap_request', actor=request.user,
+                target_key=f"item:{item.id}", target_label=item.title
             )
             messages.success(request, 'Swap request sent!')
             return redirect('request_list')
@@ -280,19 +421,18 @@ def request_create_view(request, item_id):
     return render(request, 'innercircle/request_form.html', {'form': form, 'item': item})
 
 
-@login_required
-def request_list_view(request):
+@async_login_required
+async def request_list_view(request):
     """View incoming and outgoing swap requests"""
     incoming = SwapRequest.objects.filter(receiver=request.user).select_related('sender', 'item')
     outgoing = SwapRequest.objects.filter(sender=request.user).select_related('receiver', 'item')
     
-    paginator_in = Paginator(incoming, 10)
-    paginator_out = Paginator(outgoing, 10)
-    
-    page_in = paginator_in.get_page(request.GET.get('page_in'))
-    page_out = paginator_out.get_page(request.GET.get('page_out'))
+    page_in, page_out = await _gather(
+        (_get_page, incoming, 10, request.GET.get('page_in')),
+        (_get_page, outgoing, 10, request.GET.get('page_out')),
+    )
     
-    return render(request, 'innercircle/request_list.html', {
+    return await _arender(request, 'innercircle/request_list.html', {
         'incoming': page_in,
         'outgoing': page_out
     })
@@ -324,18 +464,33 @@ def request_cancel_view(request, request_id):
     return redirect('request_list')
 
 
-@login_required
-def profile_view(request, username=None):
+@async_login_required
+async def profile_view(request, username=None):
     """View user profile"""
     if username:
-        user = get_object_or_404(User, username=username)
+        try:
+            user = await User.objects.aget(username=username)
+        except User.DoesNotExist:
+            raise Http404("No user matches the given query.")
     else:
         user = request.user
     
-    profile = get_object_or_404(Profile, user=user)
-    items = user.items.filter(is_available=True)
+    profile_qs = Profile.objects.filter(user=user)
+    items, profile, items_count, friends_count = await _gather(
+        (_evaluate, user.items.filter(is_available=True).with_swap_state(request.user)),
+        (profile_qs.first,),
+        (_count, user.items.all()),
+        (_count, FriendRequest.objects.filter(
+            Q(from_user=user, accepted=True) | Q(to_user=user, accepted=True)
+        )),
+    )
+    if profile is None:
+        raise Http404("No Profile matches the given query.")
+    # Pre-computed so the template's get_*_count() calls don't query again
+    profile.items_count = items_count
+    profile.friends_count = friends_count
     
-    return render(request, 'innercircle/profile.html', {
+    return await _arender(request, 'innercircle/profile.html', {
         'profile_user': user,
         'profile': profile,
         'items': items
@@ -385,3 +540,30 @@ def notification_read_view(request, notif_id):
     messages.success(request, "Notification marked as read.")
     return redirect(request.META.get('HTTP_REFERER', 'notifications'))
 
+
+class _Echo:
+    """File-like object for csv.writer that hands rows straight back"""
+    def write(self, value):
+        return value
+
+
+@staff_member_required
+def analytics_view(request):
+    """Staff-only platform metrics, from the rollups plus live snapshots"""
+    fmt = request.GET.get('format')
+    if fmt == 'json':
+        return JsonResponse(analytics.report_json())
+    if fmt == 'csv':
+        writer = csv.writer(_Echo())
+        rows = (writer.writerow(row) for row in [('metric', 'period', 'dimension', 'value'), *analytics.report_rows()])
+        response = StreamingHttpResponse(rows, content_type='text/csv')
+        response['Content-Disposition'] = 'attachment; filename="innercircle-metrics.csv"'
+        return response
+
+    report = analytics.report_json()
+    return render(request, 'innercircle/analytics.html', {
+        'swaps_completed': report.get('swaps_completed', []),
+        'median_accept': report.get('median_accept_minutes', []),
+        'friend_degree': report.get('friend_degree', []),
+        'items_per_user': report.get('items_per_user', []),
+    })